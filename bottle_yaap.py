@@ -5,44 +5,888 @@ Yet Another Auth Plugin (for Bottle).
 
 Users and matching sessions stored in Sqlite DB.
 """
+import os
+import atexit
+import json
+import hmac
+import hashlib
+import base64
+import csv
+import functools
+import importlib.util
+import itertools
+import math
+import mmap
+import struct
 import sqlite3
-from contextlib import contextmanager
-from collections import namedtuple
+import sys
+import threading
+import time
+import weakref
+from abc import ABC, abstractmethod
+from contextlib import contextmanager, closing
+from collections import namedtuple, OrderedDict
 from urllib.parse import quote_plus
 from secrets import token_urlsafe
-from passlib.context import CryptContext
-from passlib.hash import argon2
-import bottle
-from bottle import request, response, abort, view, redirect, template
 
 
 # TODO: implement AuthPlugin.create AuthPlugin.update and AuthPlugin.delete
 # TODO: logging
 # TODO: documentation
 
-# passlib crypt config
-pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
-# user data container
-User = namedtuple('User', ['username', 'email', 'groups'])
+
+def _lazy_import(name):
+    """ return module name, which is only loaded once it is used """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named {name!r}", name=name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+# the CLI and password-less code paths never pay for loading bottle
+bottle = _lazy_import('bottle')
+
+
+def __getattr__(name):
+    # built on first use: the passlib crypt config and the click commands
+    if name == 'pwd_context':
+        return hash_context()
+    if name == 'cli':
+        return _build_cli()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# user data container, groupmask has the GroupBits bits of its groups set
+User = namedtuple('User', ['username', 'email', 'groups', 'groupmask'],
+                  defaults=(0,))
+
+
+# CACHE
+class SessionCache(object):
+    """
+    Bounded LRU cache of session key -> User with a time to live.
+
+    Every cache registers itself so the module level helpers can invalidate
+    users changed in this process.
+    """
+
+    _instances = weakref.WeakSet()
+
+    def __init__(self, maxsize=1024, ttl=60.0):
+        self.maxsize = int(maxsize)
+        self.ttl = float(ttl)
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._keys = {}
+        self._lock = threading.Lock()
+        SessionCache._instances.add(self)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """ return the cached user for session key or None """
+        with self._lock:
+            try:
+                user, expires = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires < time.monotonic():
+                self._discard(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return user
+
+    def set(self, key, user):
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (user, time.monotonic() + self.ttl)
+            self._keys.setdefault(user.username, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._discard(next(iter(self._entries)))
+
+    def invalidate(self, key):
+        with self._lock:
+            self._discard(key)
+
+    def invalidate_user(self, username):
+        with self._lock:
+            for key in list(self._keys.get(username, ())):
+                self._discard(key)
+
+    def invalidate_digests(self, digests):
+        """ drop the sessions whose session_digest is in digests """
+        with self._lock:
+            for key in [key for key in self._entries
+                        if session_digest(key) in digests]:
+                self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys.clear()
+
+    def stats(self):
+        return {'size': len(self._entries), 'maxsize': self.maxsize,
+                'hits': self.hits, 'misses': self.misses}
+
+    def _discard(self, key):
+        try:
+            user, _ = self._entries.pop(key)
+        except KeyError:
+            return
+        keys = self._keys.get(user.username)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys[user.username]
+
+
+class SharedSessionCache(object):
+    """
+    Fixed size session key -> User table in a memory mapped file, shared by
+    all worker processes of a host.
+
+    Every slot is guarded by a sequence number that is odd while the slot is
+    written: readers never lock, they treat a slot that is being (or was
+    half) written as a miss. Writers take one of a few striped locks
+    (fcntl locks, released by the kernel if a worker dies). Entries are valid
+    for ttl seconds and only while both the database generation and the
+    epoch of the file are unchanged; invalidate_all bumps the epoch.
+
+    Only usernames, emails and group names are stored, users come back with
+    a groupmask of 0 for the reader to rebuild from its GroupBits.
+    """
+
+    _instances = weakref.WeakSet()
+    MAGIC = b'YAAPSHC1'
+    HEADER = struct.Struct('<8sQQQ')
+    # seq, epoch, generation, expires, key digest, payload length
+    SLOT = struct.Struct('<QQQd16sH')
+    STRIPES = 64
+
+    def __init__(self, path, slots=65536, slot_size=256, ttl=60.0):
+        import fcntl  # POSIX only, keep the module importable elsewhere
+        self._fcntl = fcntl
+        self.slots = int(slots)
+        self.slot_size = int(slot_size)
+        self.ttl = float(ttl)
+        self.hits = 0
+        self.misses = 0
+        self.size = self.HEADER.size + self.slots * self.slot_size
+        self._lock = threading.Lock()
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        try:
+            header = os.pread(self.fd, self.HEADER.size, 0)
+            expected = (self.MAGIC, self.slots, self.slot_size)
+            if len(header) < self.HEADER.size or \
+                    self.HEADER.unpack(header)[:3] != expected or \
+                    os.fstat(self.fd).st_size != self.size:
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, self.size)
+                os.pwrite(self.fd, self.HEADER.pack(*expected, 0), 0)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+        self.map = mmap.mmap(self.fd, self.size)
+        SharedSessionCache._instances.add(self)
+
+    def _slot(self, key):
+        digest = hashlib.sha256(key.encode()).digest()[:16]
+        index = int.from_bytes(digest[:8], 'little') % self.slots
+        return digest, self.HEADER.size + index * self.slot_size, index
+
+    @property
+    def epoch(self):
+        return self.HEADER.unpack_from(self.map, 0)[3]
+
+    @contextmanager
+    def _locked(self, stripe):
+        # stripes are locked on bytes past the end of the table
+        with self._lock:
+            self._fcntl.lockf(self.fd, self._fcntl.LOCK_EX, 1,
+                              self.size + stripe)
+            try:
+                yield
+            finally:
+                self._fcntl.lockf(self.fd, self._fcntl.LOCK_UN, 1,
+                                  self.size + stripe)
+
+    def get(self, key, generation):
+        """ return the cached User of session key or None """
+        digest, offset, _ = self._slot(key)
+        seq, epoch, gen, expires, stored, length = self.SLOT.unpack_from(
+            self.map, offset)
+        payload = self.map[offset + self.SLOT.size:
+                           offset + self.SLOT.size + length]
+        if seq & 1 or stored != digest or gen != generation or \
+                epoch != self.epoch or expires < time.time() or \
+                self.SLOT.unpack_from(self.map, offset)[0] != seq:
+            self.misses += 1
+            return None
+        try:
+            username, email, groups = json.loads(payload)
+        except ValueError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return User(username, email, frozenset(groups))
+
+    def set(self, key, user, generation):
+        """ cache user for session key, skipped if it can not be stored """
+        try:
+            payload = json.dumps([user.username, user.email,
+                                  sorted(user.groups)],
+                                 separators=(',', ':')).encode()
+        except (TypeError, ValueError):
+            return
+        if self.SLOT.size + len(payload) > self.slot_size:
+            return
+        digest, offset, index = self._slot(key)
+        try:
+            with self._locked(index % self.STRIPES):
+                seq = self.SLOT.unpack_from(self.map, offset)[0] | 1
+                struct.pack_into('<Q', self.map, offset, seq)
+                self.map[offset + self.SLOT.size:
+                         offset + self.SLOT.size + len(payload)] = payload
+                self.SLOT.pack_into(self.map, offset, seq, self.epoch,
+                                    generation, time.time() + self.ttl,
+                                    digest, len(payload))
+                struct.pack_into('<Q', self.map, offset, seq + 1)
+        except (OSError, ValueError):
+            # a failed write leaves the slot odd, which readers skip
+            return
+
+    def invalidate(self, key):
+        digest, offset, index = self._slot(key)
+        with self._locked(index % self.STRIPES):
+            seq, _, _, _, stored, _ = self.SLOT.unpack_from(self.map, offset)
+            if stored == digest:
+                struct.pack_into('<Q', self.map, offset, seq | 1)
+                struct.pack_into('<16s', self.map, offset + 32, b'')
+                struct.pack_into('<Q', self.map, offset, (seq | 1) + 1)
+
+    def invalidate_all(self):
+        with self._locked(self.STRIPES):
+            struct.pack_into('<Q', self.map, 24, self.epoch + 1)
+
+    def stats(self):
+        return {'slots': self.slots, 'hits': self.hits,
+                'misses': self.misses}
+
+    def close(self):
+        SharedSessionCache._instances.discard(self)
+        self.map.close()
+        os.close(self.fd)
+
+
+class BloomFilter(object):
+    """ set membership test without false negatives, sized for capacity """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(1, int(capacity))
+        self.size = max(8, int(-self.capacity * math.log(error_rate)
+                               / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        if isinstance(key, str):
+            key = key.encode()
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & 1 << (position & 7)
+                   for position in self._positions(key))
+
+
+class SessionFilter(object):
+    """
+    Rejects unknown session keys without asking the session store.
+
+    A Bloom filter holds the digest of every live key, it is extended by
+    logins in this process and, when the store reports changes by other
+    processes, with the keys started since the previous refresh (give or
+    take the store's overlap). Keys the store did not know are remembered
+    for ttl seconds in a bounded negative cache. Keys are never removed, so
+    the filter is rebuilt every rebuild_interval seconds to forget logged
+    out and purged sessions.
+    """
+
+    def __init__(self, store, capacity=100000, maxsize=4096, ttl=30.0,
+                 rebuild_interval=300.0):
+        self.store = store
+        self.capacity = int(capacity)
+        self.maxsize = int(maxsize)
+        self.ttl = float(ttl)
+        self.rebuild_interval = float(rebuild_interval)
+        self.rejected = 0
+        self.passed = 0
+        self.negative = OrderedDict()
+        self._lock = threading.RLock()
+        self.rebuild()
+
+    def rebuild(self):
+        """ start over with a filter holding the live session keys """
+        # holding the lock keeps concurrent add() calls out of the old filter
+        with self._lock:
+            self.built = time.monotonic()
+            keys, marker = self.store.keys()
+            bloom = BloomFilter(max(self.capacity, 2 * len(keys)))
+            for key in keys:
+                bloom.add(key)
+            self.bloom, self.marker = bloom, marker
+
+    def add(self, key):
+        """ register a new session key """
+        with self._lock:
+            self.bloom.add(session_digest(key))
+            if self.bloom.count > self.bloom.capacity:
+                # too many (mostly dead) keys for the error rate
+                self.rebuild()
+
+    def reject(self, key):
+        """ remember that key is not a live session """
+        digest = session_digest(key)
+        with self._lock:
+            self.negative[digest] = time.monotonic() + self.ttl
+            self.negative.move_to_end(digest)
+            while len(self.negative) > self.maxsize:
+                self.negative.popitem(last=False)
+
+    def might_exist(self, key):
+        """ return False if key certainly is no live session """
+        digest = session_digest(key)
+        expires = self.negative.get(digest)
+        if expires is not None and expires > time.monotonic():
+            self.rejected += 1
+            return False
+        if time.monotonic() - self.built > self.rebuild_interval:
+            # claim the rebuild so concurrent requests skip it
+            self.built = time.monotonic()
+            self.rebuild()
+        if digest not in self.bloom and self.store.changed():
+            with self._lock:
+                keys, marker = self.store.keys(self.marker)
+                for new in keys:
+                    self.bloom.add(new)
+                self.marker = marker
+        if digest in self.bloom:
+            self.passed += 1
+            return True
+        self.reject(key)
+        self.rejected += 1
+        return False
+
+    def stats(self):
+        return {'keys': self.bloom.count, 'negative': len(self.negative),
+                'passed': self.passed, 'rejected': self.rejected}
+
+
+def invalidate_user(username):
+    """ drop username from every session cache in this process """
+    invalidate_users((username,))
+
+
+def invalidate_users(usernames):
+    """ drop many users from every session cache in this process """
+    for cache in list(SessionCache._instances):
+        for username in usernames:
+            cache.invalidate_user(username)
+    for cache in list(SharedSessionCache._instances):
+        # entries can not be found by username, drop them all
+        cache.invalidate_all()
+
+
+class GroupBits(object):
+    """
+    Maps groups to their bit in User.groupmask.
+
+    Bits are handed out densely in groupid order as groups are first seen,
+    and never reused in this process, so masks cached before a refresh keep
+    their meaning. Module level helpers that add or delete groups mark every
+    instance in this process stale.
+    """
+
+    _instances = weakref.WeakSet()
+
+    def __init__(self):
+        self.bits = {}
+        self.positions = {}
+        self.known = 0
+        self.version = 0
+        self.stale = True
+        GroupBits._instances.add(self)
+
+    def refresh(self, cursor):
+        self.stale = False
+        rows = cursor.execute(
+            "SELECT groupid, name FROM groups ORDER BY groupid").fetchall()
+        positions = dict(self.positions)
+        for groupid, _ in rows:
+            positions.setdefault(groupid, len(positions))
+        self.positions = positions
+        self.bits = {name: positions[groupid] for groupid, name in rows}
+        self.known = (1 << len(positions)) - 1
+        self.version += 1
+
+    def mask_ids(self, groupids, cursor):
+        """ return the bitmask of groupids, refreshed from cursor if needed """
+        if self.stale or any(groupid not in self.positions
+                             for groupid in groupids):
+            self.refresh(cursor)
+        mask = 0
+        for groupid in groupids:
+            mask |= 1 << self.positions[groupid]
+        return mask
+
+    def mask(self, names):
+        """ return the bitmask of the known groups in names """
+        mask = 0
+        for name in names:
+            if name in self.bits:
+                mask |= 1 << self.bits[name]
+        return mask
+
+
+def groups_changed():
+    """ mark the group bits of this process stale """
+    for bits in list(GroupBits._instances):
+        bits.stale = True
+
+
+class GroupRequirement(object):
+    """ the auth groups of a route, compiled to a bitmask """
+
+    def __init__(self, names, bits, refresh):
+        self.names = frozenset(names)
+        self.bits = bits
+        self.refresh = refresh
+        self.version = None
+        self.mask = 0
+
+    def allows(self, groupmask):
+        """ return whether a user with groupmask belongs to any group """
+        if self.bits.stale or groupmask & ~self.bits.known:
+            # groups were added or removed since the last refresh
+            self.refresh()
+        if self.version != self.bits.version:
+            self.mask = self.bits.mask(self.names)
+            self.version = self.bits.version
+        return bool(groupmask & self.mask)
+
+
+# PASSWORD HASHING
+class Overloaded(RuntimeError):
+    """ raised when too much hashing work is already queued """
+
+
+# argon2 parameters stored in the settings table, None for passlib defaults
+HASH_SETTINGS = ('argon2_time_cost', 'argon2_memory_cost',
+                 'argon2_parallelism')
+
+
+def hash_params(settings):
+    """ return the argon2 parameters found in settings as a hashable tuple """
+    return tuple((key[len('argon2_'):], int(settings[key]))
+                 for key in HASH_SETTINGS if settings.get(key) is not None)
+
+
+@functools.lru_cache(maxsize=8)
+def hash_context(params=()):
+    """ return a CryptContext hashing with the argon2 parameters params """
+    from passlib.context import CryptContext
+    return CryptContext(schemes=["argon2"], deprecated="auto",
+                        **{f'argon2__{name}': value for name, value in params})
+
+
+def hash_password(password, params=()):
+    return hash_context(params).hash(password)
+
+
+def verify_password(password, pw_hash):
+    return hash_context().verify(password, pw_hash)
+
+
+def verify_and_update(password, pw_hash, params=()):
+    """
+    Check password against pw_hash, return whether it matches and, if
+    pw_hash was made with other parameters than params, a new hash.
+    """
+    return hash_context(params).verify_and_update(password, pw_hash)
+
+
+def _measure(params, rounds=2):
+    from passlib.hash import argon2
+    hasher = argon2.using(**params)
+    best = float('inf')
+    for _ in range(rounds):
+        started = time.perf_counter()
+        hasher.hash('calibration')
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def calibrate(latency=0.5, concurrency=None, max_memory=1048576,
+              parallelism=None):
+    """
+    Benchmark argon2 on this machine and return the parameters for which
+    concurrency simultaneous logins, sharing all cores and at most
+    max_memory KiB, each verify within latency seconds, together with the
+    seconds one hash takes.
+    """
+    cores = os.cpu_count() or 1
+    concurrency = max(1, int(concurrency or cores))
+    parallelism = int(parallelism or max(1, cores // concurrency))
+    # logins beyond the number of cores wait for a turn
+    budget = latency / math.ceil(concurrency * parallelism / cores)
+    params = {'time_cost': 1, 'parallelism': parallelism,
+              'memory_cost': max(8 * parallelism,
+                                 int(max_memory) // concurrency)}
+    seconds = _measure(params)
+    while seconds > budget and params['memory_cost'] > 8 * parallelism:
+        params['memory_cost'] = max(8 * parallelism,
+                                    params['memory_cost'] // 2)
+        seconds = _measure(params)
+    params['time_cost'] = max(1, int(budget / seconds))
+    seconds = _measure(params)
+    while seconds > budget and params['time_cost'] > 1:
+        params['time_cost'] -= 1
+        seconds = _measure(params)
+    return params, seconds
+
+
+def _timed(func, *args):
+    started = time.monotonic()
+    return started, func(*args)
+
+
+class HashPool(object):
+    """
+    Bounded pool of workers for the (deliberately slow) argon2 work.
+
+    Password hashing and verification run on their own workers so a burst of
+    logins cannot tie up every request thread. Once max_queue calls are
+    pending new calls raise Overloaded instead of waiting.
+    """
+
+    def __init__(self, workers=None, max_queue=None, executor='thread'):
+        self.workers = int(workers or os.cpu_count() or 1)
+        self.max_queue = int(max_queue or 4 * self.workers)
+        if executor == 'process':
+            from concurrent.futures import ProcessPoolExecutor
+            self.executor = ProcessPoolExecutor(self.workers)
+        elif executor == 'thread':
+            # argon2-cffi releases the GIL while hashing
+            from concurrent.futures import ThreadPoolExecutor
+            self.executor = ThreadPoolExecutor(
+                self.workers, thread_name_prefix='yaap-hash')
+        else:
+            raise ValueError(f"{executor!r} is not a valid executor")
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_time = 0.0
+        self.run_time = 0.0
+        self.max_wait = 0.0
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args):
+        """ run func(*args) on the pool and wait for its result """
+        with self._lock:
+            if self.pending >= self.max_queue:
+                self.rejected += 1
+                raise Overloaded('Too many pending password checks.')
+            self.pending += 1
+        queued = time.monotonic()
+        try:
+            started, result = self.executor.submit(_timed, func, *args
+                                                   ).result()
+        finally:
+            finished = time.monotonic()
+            with self._lock:
+                self.pending -= 1
+        with self._lock:
+            self.completed += 1
+            self.wait_time += started - queued
+            self.run_time += finished - started
+            self.max_wait = max(self.max_wait, started - queued)
+        return result
+
+    def hash(self, password, params=()):
+        return self.submit(hash_password, password, params)
+
+    def verify(self, password, pw_hash):
+        return self.submit(verify_password, password, pw_hash)
+
+    def verify_and_update(self, password, pw_hash, params=()):
+        return self.submit(verify_and_update, password, pw_hash, params)
+
+    def stats(self):
+        completed = self.completed or 1
+        return {'workers': self.workers, 'max_queue': self.max_queue,
+                'pending': self.pending, 'completed': self.completed,
+                'rejected': self.rejected,
+                'avg_wait': self.wait_time / completed,
+                'avg_run': self.run_time / completed,
+                'max_wait': self.max_wait}
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+# THROTTLING
+class Throttled(RuntimeError):
+    """ raised when too many login attempts were made """
+
+    def __init__(self, retry_after):
+        super().__init__('Too many login attempts, try again later.')
+        self.retry_after = retry_after
+
+
+class LoginThrottle(object):
+    """
+    Token buckets limiting login attempts per username and per client
+    address.
+
+    A bucket holds up to burst attempts and refills with rate attempts per
+    second. An attempt takes one from the bucket of its username and of its
+    address, or raises Throttled without taking any if one of them is
+    empty. At most maxsize buckets are kept, least recently used first out.
+    """
+
+    def __init__(self, burst=10, rate=0.1, addr_burst=100, addr_rate=1.0,
+                 maxsize=100000):
+        self.limits = {'user': (float(burst), float(rate)),
+                       'addr': (float(addr_burst), float(addr_rate))}
+        self.maxsize = int(maxsize)
+        self.buckets = OrderedDict()
+        self.allowed = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    def keys(self, username, address):
+        keys = [('user', f'user:{username}')]
+        if address:
+            keys.append(('addr', f'addr:{address}'))
+        return keys
+
+    def acquire(self, username, address=None):
+        """ count a login attempt, raise Throttled if it is over limit """
+        now = time.monotonic()
+        with self._lock:
+            levels = []
+            for kind, key in self.keys(username, address):
+                burst, rate = self.limits[kind]
+                tokens, updated = self.buckets.get(key, (burst, now))
+                tokens = min(burst, tokens + (now - updated) * rate)
+                if tokens < 1:
+                    self.throttled += 1
+                    raise Throttled((1 - tokens) / rate if rate else 3600)
+                levels.append((key, tokens - 1))
+            for key, tokens in levels:
+                self.buckets[key] = (tokens, now)
+                self.buckets.move_to_end(key)
+            while len(self.buckets) > self.maxsize:
+                self.buckets.popitem(last=False)
+            self.allowed += 1
+
+    def stats(self):
+        return {'buckets': len(self.buckets), 'allowed': self.allowed,
+                'throttled': self.throttled}
+
+
+class SQLiteLoginThrottle(LoginThrottle):
+    """
+    LoginThrottle keeping its buckets in the throttle table, so all worker
+    processes share them. Every attempt is one small write transaction.
+    """
+
+    def __init__(self, db, burst=10, rate=0.1, addr_burst=100, addr_rate=1.0,
+                 purge_every=1000):
+        super().__init__(burst, rate, addr_burst, addr_rate)
+        self.db = db
+        self.purge_every = int(purge_every)
+
+    def acquire(self, username, address=None):
+        now = time.time()
+        try:
+            with atomic(self.db) as cursor:
+                for kind, key in self.keys(username, address):
+                    self._take(cursor, key, now, *self.limits[kind])
+                if self.allowed % self.purge_every == 0:
+                    self._purge(cursor, now)
+        except Throttled:
+            self.throttled += 1
+            raise
+        self.allowed += 1
+
+    def _take(self, cursor, key, now, burst, rate):
+        cursor.execute("""
+            INSERT INTO throttle (key, tokens, updated) VALUES (?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET
+                tokens = min(?, tokens + (excluded.updated - updated) * ?) - 1,
+                updated = excluded.updated
+            WHERE min(?, tokens + (excluded.updated - updated) * ?) >= 1
+            """, (key, burst - 1, now, burst, rate, burst, rate))
+        if cursor.rowcount == 0:
+            tokens, updated = cursor.execute(
+                "SELECT tokens, updated FROM throttle WHERE key = ?",
+                (key,)).fetchone()
+            tokens = min(burst, tokens + (now - updated) * rate)
+            raise Throttled((1 - tokens) / rate if rate else 3600)
+
+    def _purge(self, cursor, now):
+        # buckets refilled completely are the same as no bucket
+        refill = max(burst / rate if rate else 86400
+                     for burst, rate in self.limits.values())
+        cursor.execute("DELETE FROM throttle WHERE updated < ?",
+                       (now - refill,))
+
+    def stats(self):
+        with atomic(self.db, readonly=True) as cursor:
+            buckets = cursor.execute(
+                "SELECT count(*) FROM throttle").fetchone()[0]
+        return {'buckets': buckets, 'allowed': self.allowed,
+                'throttled': self.throttled}
 
 
 # DATABASE
+class _ThreadConnection(object):
+    """ holds the connection of one thread, closing it when the thread ends """
+
+    __slots__ = ('connection', '__weakref__')
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __del__(self):
+        self.connection.close()
+
+
+class ConnectionPool(object):
+    """
+    Long-lived SQLite connections, one per thread.
+
+    Connections are tuned with the given pragmas when opened and are dropped
+    when the process forks, so pre-fork servers never share a connection.
+    The pool only holds weak references: a connection is closed when its
+    thread ends, so thread per request servers do not pile them up.
+    """
+
+    def __init__(self, dbfile, journal_mode='wal', synchronous='normal',
+                 cache_size=-8000, mmap_size=268435456, timeout=5.0):
+        self.dbfile = dbfile
+        self.pragmas = (
+            ('foreign_keys', 'ON'),
+            ('journal_mode', journal_mode),
+            ('synchronous', synchronous),
+            ('cache_size', int(cache_size)),
+            ('mmap_size', int(mmap_size)),
+        )
+        self.timeout = float(timeout)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = weakref.WeakSet()
+        self._pid = os.getpid()
+
+    def connect(self):
+        """ open a new tuned connection to the database """
+        connection = sqlite3.connect(self.dbfile, timeout=self.timeout,
+                                     isolation_level=None,
+                                     check_same_thread=False)
+        for pragma, value in self.pragmas:
+            if value is not None:
+                connection.execute(f'PRAGMA {pragma} = {value};')
+        return connection
+
+    def connection(self):
+        """ return the connection owned by the calling thread """
+        if self._pid != os.getpid():
+            # forked: connections belong to the parent process
+            with self._lock:
+                self._local = threading.local()
+                self._connections = weakref.WeakSet()
+                self._pid = os.getpid()
+        owner = getattr(self._local, 'owner', None)
+        if owner is None:
+            owner = self._local.owner = _ThreadConnection(self.connect())
+            with self._lock:
+                self._connections.add(owner)
+        return owner.connection
+
+    def close(self):
+        """ close all connections opened by this pool """
+        with self._lock:
+            owners = list(self._connections)
+            self._connections = weakref.WeakSet()
+            self._local = threading.local()
+        if self._pid == os.getpid():
+            for owner in owners:
+                owner.connection.close()
+
+
 @contextmanager
-def atomic(dbfile):
-    connection = sqlite3.connect(dbfile)
-    connection.execute('PRAGMA foreign_keys = ON;')
-    cursor = connection.execute('BEGIN TRANSACTION')
-    yield cursor
+def atomic(dbfile, readonly=False):
+    """
+    Run a transaction and yield its cursor.
+
+    dbfile is either a path, which is opened for this transaction only, or a
+    ConnectionPool. Read-only transactions never take the write lock and
+    refuse to write (PRAGMA query_only); the others take it up front, so
+    they wait for the busy timeout instead of failing on lock upgrade.
+    """
+    pooled = isinstance(dbfile, ConnectionPool)
+    if pooled:
+        connection = dbfile.connection()
+    else:
+        connection = sqlite3.connect(dbfile)
+        connection.execute('PRAGMA foreign_keys = ON;')
+    if readonly:
+        connection.execute('PRAGMA query_only = ON;')
+        cursor = connection.execute('BEGIN DEFERRED')
+    else:
+        cursor = connection.execute('BEGIN IMMEDIATE')
     try:
-        connection.commit()
-    except connection.Error:
+        yield cursor
+    except BaseException:
         connection.rollback()
+        raise
+    else:
+        try:
+            connection.commit()
+        except connection.Error:
+            connection.rollback()
     finally:
-        connection.close()
+        cursor.close()
+        if not pooled:
+            connection.close()
+        elif readonly:
+            # the connection is reused by the next transaction
+            connection.execute('PRAGMA query_only = OFF;')
 
 
 def create_tables(cursor):
-    """ create user, usergroup and group tables """
+    """ create user, usergroup and group tables at the latest version """
     cursor.execute("""
         CREATE TABLE users(
             userid      INTEGER PRIMARY KEY,
@@ -87,13 +931,187 @@ def create_tables(cursor):
     cursor.execute(
         "CREATE UNIQUE INDEX idx_users_username ON users (username)"
     )
+    migrate(cursor)
+
+
+# MIGRATIONS
+# Every step upgrades the schema by one version (stored as PRAGMA
+# user_version). Steps must be safe to run on a database that already has
+# their changes.
+def _add_revocations(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS revocations(
+            userid   INTEGER PRIMARY KEY,
+            revoked  REAL NOT NULL
+        );
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_revocations_revoked "
+                   "ON revocations (revoked)")
+
+
+def _add_session_expiry(cursor):
+    columns = {row[1] for row in
+               cursor.execute("PRAGMA table_info(sessions)")}
+    if 'expires' not in columns:
+        cursor.execute("ALTER TABLE sessions "
+                       "ADD COLUMN expires TEXT NOT NULL DEFAULT ''")
+        cursor.execute("UPDATE sessions "
+                       "SET expires = datetime(started, '+3 hour')")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires "
+                   "ON sessions (expires)")
+
+
+def _add_lookup_indexes(cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sessions_key "
+                   "ON sessions (key)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_usergroups_groupid "
+                   "ON usergroups (groupid)")
+
+
+def _add_generation(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS generation(
+            id      INTEGER PRIMARY KEY CHECK (id = 0),
+            value   INTEGER NOT NULL
+        );
+    """)
+    cursor.execute("INSERT OR IGNORE INTO generation VALUES (0, 0)")
+
+
+def _add_session_started_index(cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sessions_started "
+                   "ON sessions (started)")
+
+
+def _add_throttle(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS throttle(
+            key      TEXT PRIMARY KEY,
+            tokens   REAL NOT NULL,
+            updated  REAL NOT NULL
+        ) WITHOUT ROWID;
+    """)
+
+
+def _compact_sessions(cursor):
+    # sessions keyed by the digest of their key, with epoch timestamps
+    columns = {row[1]: row[2] for row in
+               cursor.execute("PRAGMA table_info(sessions)")}
+    if columns['key'] == 'BLOB':
+        return
+    users = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'users'").fetchone()
+    reference = """,
+            FOREIGN KEY (userid) REFERENCES users (userid)
+            ON DELETE CASCADE ON UPDATE NO ACTION""" if users else ''
+    cursor.execute(f"""
+        CREATE TABLE sessions_compact(
+            key      BLOB PRIMARY KEY,
+            userid   INTEGER NOT NULL,
+            started  INTEGER NOT NULL,
+            expires  INTEGER NOT NULL{reference}
+        ) WITHOUT ROWID;
+    """)
+    # copy inside SQLite instead of loading every session into memory
+    cursor.connection.create_function('yaap_session_digest', 1,
+                                      session_digest)
+    cursor.execute("""
+        INSERT INTO sessions_compact
+        SELECT yaap_session_digest(key), userid,
+               coalesce(CAST(strftime('%s', started) AS INTEGER), 0),
+               coalesce(CAST(strftime('%s', expires) AS INTEGER), 0)
+        FROM sessions
+        """)
+    cursor.execute("DROP TABLE sessions")
+    cursor.execute("ALTER TABLE sessions_compact RENAME TO sessions")
+    cursor.execute("CREATE INDEX idx_sessions_userid ON sessions (userid)")
+    cursor.execute("CREATE INDEX idx_sessions_expires ON sessions (expires)")
+    cursor.execute("CREATE INDEX idx_sessions_started ON sessions (started)")
+
+
+def _add_logouts(cursor):
+    # single sessions ended recently, polled by other workers' caches
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS logouts(
+            key      BLOB PRIMARY KEY,
+            revoked  REAL NOT NULL
+        ) WITHOUT ROWID;
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_logouts_revoked "
+                   "ON logouts (revoked)")
+
+
+MIGRATIONS = [
+    _add_revocations,
+    _add_session_expiry,
+    _add_lookup_indexes,
+    _add_generation,
+    _add_session_started_index,
+    _compact_sessions,
+    _add_throttle,
+    _add_logouts,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def schema_version(cursor):
+    return cursor.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(cursor, target=SCHEMA_VERSION, migrations=MIGRATIONS):
+    """ apply the migration steps needed to reach version target """
+    for version in range(schema_version(cursor), target):
+        migrations[version](cursor)
+        cursor.execute(f"PRAGMA user_version = {version + 1}")
+
+
+# Sessions can live in a database file of their own (auth.session_dbfile),
+# which has a separate schema version and migration steps.
+SESSION_MIGRATIONS = [
+    _add_session_started_index,
+    _compact_sessions,
+    _add_logouts,
+]
+SESSION_SCHEMA_VERSION = len(SESSION_MIGRATIONS)
+
+
+def create_session_tables(cursor):
+    """ create the sessions table of a separate session database """
+    cursor.execute("""
+        CREATE TABLE sessions(
+            userid   INTEGER PRIMARY KEY,
+            key      TEXT NOT NULL,
+            started  TEXT DEFAULT (datetime('now')),
+            expires  TEXT NOT NULL DEFAULT ''
+        );
+    """)
+    cursor.execute("CREATE INDEX idx_sessions_key ON sessions (key)")
+    cursor.execute("CREATE INDEX idx_sessions_expires ON sessions (expires)")
+    migrate(cursor, SESSION_SCHEMA_VERSION, SESSION_MIGRATIONS)
+
+
+def get_generation(cursor):
+    """ return the counter bumped by every change of users or settings """
+    return cursor.execute("SELECT value FROM generation").fetchone()[0]
+
+
+def bump_generation(cursor):
+    """ tell every process caching users or settings to reload them """
+    cursor.execute("UPDATE generation SET value = value + 1")
+
+
+# publicly known, only good enough for cookies naming a session row
+DEFAULT_COOKIE_SECRET = 'sneakyyaapi'
 
 
 def get_conf(cursor):
     conf = {
         'allow_registration': None,
         'cookie_key': 'bottle_yaap',
-        'cookie_secret': 'sneakyyaapi'
+        'cookie_secret': DEFAULT_COOKIE_SECRET,
+        'argon2_time_cost': None,
+        'argon2_memory_cost': None,
+        'argon2_parallelism': None,
     }
     for key, value in cursor.execute("SELECT key, value FROM settings"):
         conf[key] = value
@@ -131,25 +1149,90 @@ def get_usergroups(cursor, username):
     return {g[0] for g in groups}
 
 
-def get_user(cursor, username):
-    return User(username, get_email(cursor, username),
-                get_usergroups(cursor, username))
+# username, email, the unit separator joined group names and the comma
+# separated groupids of a user
+USER_SELECT = """
+    SELECT users.username, users.email, group_concat(groups.name, char(31)),
+           group_concat(groups.groupid)
+    FROM users
+    LEFT JOIN usergroups ON usergroups.userid = users.userid
+    LEFT JOIN groups ON groups.groupid = usergroups.groupid
+"""
+
+
+def user_from_row(row, cursor=None, bits=None):
+    """
+    Build a User from a USER_SELECT result row, with a groupmask from the
+    GroupBits bits (refreshed from cursor if needed) if given.
+    """
+    username, email, groups, groupids = row
+    groupmask = 0
+    if bits is not None and groupids:
+        groupmask = bits.mask_ids(
+            [int(groupid) for groupid in groupids.split(',')], cursor)
+    return User(username, email,
+                frozenset(groups.split('\x1f') if groups else ()), groupmask)
 
 
-def create_user(cursor, username, password, email, groups=None):
+def get_user(cursor, username, bits=None):
+    row = cursor.execute(USER_SELECT + """
+        WHERE users.username = ?
+        GROUP BY users.userid
+        """, (username,)).fetchone()
+    if row is None:
+        raise LookupError(f"No user with username {username!r}")
+    return user_from_row(row, cursor, bits)
+
+
+def get_user_by_id(cursor, userid, bits=None):
+    """ return the User with userid or None """
+    row = cursor.execute(USER_SELECT + """
+        WHERE users.userid = ?
+        GROUP BY users.userid
+        """, (userid,)).fetchone()
+    return None if row is None else user_from_row(row, cursor, bits)
+
+
+def get_session_user(cursor, session_key, bits=None):
+    """ return the User owning session_key or None """
+    row = cursor.execute(USER_SELECT + """
+        INNER JOIN sessions ON sessions.userid = users.userid
+        WHERE sessions.key = ?
+        AND sessions.expires > ?
+        GROUP BY users.userid
+        """, (session_digest(session_key), int(time.time()))).fetchone()
+    return None if row is None else user_from_row(row, cursor, bits)
+
+
+def create_user(cursor, username, password, email, groups=None,
+                hasher=None):
     """ create a user, return user_id """
     groups = groups or []
+    params = hash_params(get_conf(cursor))
+    pw_hash = (hasher.hash(password, params) if hasher
+               else hash_password(password, params))
     cursor.execute(
         "INSERT INTO users ('username', 'password', 'email') VALUES(?, ?, ?)",
-        (username, argon2.hash(password), email)
+        (username, pw_hash, email)
     )
-    for group in groups:
-        create_usergroup(cursor, username, group)
+    if groups:
+        # a new user has no tokens to revoke
+        userid = get_userid(cursor, username)
+        bump_generation(cursor)
+        for group in groups:
+            _insert_usergroup(cursor, userid, group)
 
 
 def create_usergroup(cursor, username, group):
     userid = get_userid(cursor, username)
+    invalidate_user(username)
+    bump_generation(cursor)
+    # issued tokens carry the old groups
+    revoke_user(cursor, username)
+    _insert_usergroup(cursor, userid, group)
+
 
+def _insert_usergroup(cursor, userid, group):
     try:
         groupid = next(cursor.execute(
             "SELECT groupid FROM groups WHERE name = ?", (group,)))[0]
@@ -158,6 +1241,7 @@ def create_usergroup(cursor, username, group):
             "INSERT INTO groups ('name') VALUES (?)", (group,)
         )
         groupid = cursor.lastrowid
+        groups_changed()
 
     # finally create usergroup
     cursor.execute(
@@ -167,23 +1251,48 @@ def create_usergroup(cursor, username, group):
 
 
 def remove_user(cursor, username):
-    """ remove the user and all groups without a user """
+    """ remove the user and those of its groups left without a user """
+    invalidate_user(username)
+    revoke_user(cursor, username)
+    bump_generation(cursor)
+    groupids = cursor.execute("""
+        SELECT groupid
+        FROM usergroups
+        WHERE userid = (SELECT userid FROM users WHERE username = ?)
+        """, (username,)).fetchall()
     cursor.execute("DELETE FROM users WHERE username = ?", (username,))
-    cursor.execute("""
+    # only the groups of the user can have become empty,
+    # idx_usergroups_groupid answers whether they still have members
+    cursor.executemany("""
         DELETE
         FROM groups
-        WHERE NOT EXISTS(
-            SELECT
-                NULL
-            FROM
-                usergroups ug
-            WHERE
-                ug.groupid = groupid
+        WHERE
+            groupid = ?
+            AND NOT EXISTS(
+                SELECT NULL
+                FROM usergroups
+                WHERE usergroups.groupid = groups.groupid
             )
-        """)
+        """, groupids)
+    if cursor.rowcount:
+        groups_changed()
+
+
+def users_in_group(cursor, group):
+    """ return the usernames of the members of group """
+    return {row[0] for row in cursor.execute("""
+        SELECT users.username
+        FROM groups
+        INNER JOIN usergroups ON usergroups.groupid = groups.groupid
+        INNER JOIN users ON users.userid = usergroups.userid
+        WHERE groups.name = ?
+        """, (group,))}
 
 
 def remove_usergroup(cursor, username, group):
+    invalidate_user(username)
+    bump_generation(cursor)
+    revoke_user(cursor, username)
     cursor.execute("""
         DELETE
         FROM usergroups
@@ -194,7 +1303,7 @@ def remove_usergroup(cursor, username, group):
     """, (username, group))
 
 
-def update_user(cursor, username, attr, value):
+def update_user(cursor, username, attr, value, hasher=None):
     """
     Update user username, email, password or groups.
 
@@ -203,15 +1312,18 @@ def update_user(cursor, username, attr, value):
     """
     if attr not in ['username', 'password', 'email', 'groups']:
         raise ValueError(f"{attr!r} is not a valid user attribute")
+    invalidate_user(username)
+    bump_generation(cursor)
+    if attr != 'password':
+        # issued tokens carry the old username, email and groups
+        revoke_user(cursor, username)
     if attr == 'password':
-        value = argon2.hash(value)
+        params = hash_params(get_conf(cursor))
+        value = (hasher.hash(value, params) if hasher
+                 else hash_password(value, params))
     elif attr == 'groups':
-        current = get_usergroups(cursor, username)
-        for group in current.difference(value):
-            remove_usergroup(cursor, username, group)
-        for group in value.difference(current):
-            create_usergroup(cursor, username, group)
-        return 
+        set_user_groups(cursor, username, value)
+        return
 
     cursor.execute(f"""
         UPDATE users
@@ -224,17 +1336,41 @@ def update_user(cursor, username, attr, value):
 
 def configure(cursor, key, value):
     """ set YAAP configuration option """
-    allowed_keys = {'registration', 'cookie_key', 'cookie_secret'}
+    allowed_keys = {'registration', 'cookie_key', 'cookie_secret',
+                    *HASH_SETTINGS}
     if key not in allowed_keys:
         raise ValueError(f"{key!r} is not a valid settings key")
+    if key in HASH_SETTINGS and value is not None:
+        # every hash reads these, a bad value would break all logins
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            value = 0
+        if value < 1:
+            raise ValueError(f"{key} must be a positive integer or NULL")
 
+    bump_generation(cursor)
     cursor.execute(
         "REPLACE INTO settings ('key', 'value') VALUES (?, ?)",
         (key, value)
     )
 
 
-def logout_user(cursor, username):
+def logout_user(cursor, username, session_cursor=None):
+    """
+    End all sessions of username, stored in the session database of
+    session_cursor if given.
+    """
+    invalidate_user(username)
+    revoke_user(cursor, username)
+    bump_generation(cursor)
+    if session_cursor is not None:
+        row = cursor.execute("SELECT userid FROM users WHERE username = ?",
+                             (username,)).fetchone()
+        if row is not None:
+            session_cursor.execute("DELETE FROM sessions WHERE userid = ?",
+                                   row)
+        return
     cursor.execute("""
         DELETE FROM sessions
         WHERE
@@ -242,17 +1378,1060 @@ def logout_user(cursor, username):
         """, (username,))
 
 
-def login_user(cursor, username):
-    """ create new session for user with username, return session key """
+def login_user(cursor, username, lifetime=10800, session_cursor=None):
+    """
+    create new session for user with username, return session key
+
+    The session is stored in the session database of session_cursor if
+    given.
+    """
     userid = get_userid(cursor, username)
+    return create_session(session_cursor or cursor, userid, lifetime)
+
+
+def session_digest(session_key):
+    """ return the fixed width digest under which session_key is stored """
+    return hashlib.blake2b(session_key.encode(), digest_size=16).digest()
+
+
+def create_session(cursor, userid, lifetime=10800):
+    """ start another session of userid, return session key """
     key = token_urlsafe()
-    cursor.execute(
-        "REPLACE INTO sessions ('userid', 'key') VALUES (?, ?)",
-        (userid, key)
+    now = int(time.time())
+    cursor.execute("""
+        INSERT INTO sessions (key, userid, started, expires)
+        VALUES (?, ?, ?, ?)
+        """, (session_digest(key), userid, now, now + int(lifetime))
     )
     return key
 
 
+def purge_sessions(cursor, limit=500):
+    """ delete at most limit expired sessions, return the number deleted """
+    cursor.execute("""
+        DELETE FROM sessions
+        WHERE key IN (
+            SELECT key FROM sessions
+            WHERE expires <= ?
+            LIMIT ?
+        )
+        """, (int(time.time()), limit))
+    return cursor.rowcount
+
+
+def reap_sessions(dbfile, batch=500):
+    """
+    Delete all expired sessions, batch rows per transaction so the write
+    lock is only held briefly. Return the number of deleted sessions.
+    """
+    total = 0
+    while True:
+        with atomic(dbfile) as cursor:
+            deleted = purge_sessions(cursor, batch)
+        total += deleted
+        if deleted < batch:
+            return total
+
+
+# SESSION STORES
+class SessionStore(ABC):
+    """
+    Interface of the session storage used by AuthPlugin.
+
+    A session maps a random key to a userid until it expires; a user can
+    have several sessions. Stores only keep the session_digest of a key.
+    """
+
+    @abstractmethod
+    def create(self, userid, lifetime):
+        """ start a session for userid, return its key """
+
+    @abstractmethod
+    def lookup(self, key):
+        """ return the userid of the live session key or None """
+
+    @abstractmethod
+    def touch(self, key, lifetime):
+        """ extend the session key to expire lifetime seconds from now """
+
+    @abstractmethod
+    def touch_many(self, expiries):
+        """
+        Extend many sessions at once, given (key, expires) pairs with
+        expires in epoch seconds. Sessions never expire earlier.
+        """
+
+    @abstractmethod
+    def revoke(self, key=None, userid=None):
+        """ end the session with key, or all sessions of userid """
+
+    @abstractmethod
+    def purge(self, limit=500):
+        """ delete at most limit expired sessions, return how many """
+
+    @abstractmethod
+    def keys(self, since=None):
+        """
+        Return the key digests of the live sessions (started at or after the
+        marker since) and a marker for the next call.
+        """
+
+    def changed(self):
+        """ return whether other processes may have created sessions """
+        return True
+
+    def logouts(self, since=None):
+        """
+        Return the digests of the sessions revoked by key since the marker
+        since, and a marker for the next call.
+        """
+        return [], None
+
+    def close(self):
+        pass
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Sessions stored in the sessions table.
+
+    keys() markers lie overlap seconds in the past: a session is stamped
+    before its transaction waits for the write lock, so it can commit with
+    a started time before a marker handed out in the meantime.
+    """
+
+    LOGOUT_RETENTION = 3600
+
+    def __init__(self, db, overlap=35.0):
+        self.db = db
+        self.overlap = float(overlap)
+        self._seen = threading.local()
+
+    def create(self, userid, lifetime):
+        with atomic(self.db) as cursor:
+            return create_session(cursor, userid, lifetime)
+
+    def lookup(self, key):
+        with atomic(self.db, readonly=True) as cursor:
+            row = cursor.execute("""
+                SELECT userid FROM sessions
+                WHERE key = ? AND expires > ?
+                """, (session_digest(key), int(time.time()))).fetchone()
+        return None if row is None else row[0]
+
+    def touch(self, key, lifetime):
+        with atomic(self.db) as cursor:
+            cursor.execute(
+                "UPDATE sessions SET expires = ? WHERE key = ?",
+                (int(time.time()) + int(lifetime), session_digest(key)))
+
+    def touch_many(self, expiries):
+        with atomic(self.db) as cursor:
+            cursor.executemany(
+                "UPDATE sessions SET expires = max(expires, ?) WHERE key = ?",
+                ((int(expires), session_digest(key))
+                 for key, expires in expiries))
+
+    def revoke(self, key=None, userid=None):
+        with atomic(self.db) as cursor:
+            if key is not None:
+                cursor.execute("DELETE FROM sessions WHERE key = ?",
+                               (session_digest(key),))
+                cursor.execute("REPLACE INTO logouts VALUES (?, ?)",
+                               (session_digest(key), time.time()))
+            if userid is not None:
+                cursor.execute("DELETE FROM sessions WHERE userid = ?",
+                               (userid,))
+
+    def purge(self, limit=500):
+        with atomic(self.db) as cursor:
+            # cached sessions outlive a logout by a cache ttl at most
+            cursor.execute("DELETE FROM logouts WHERE revoked < ?",
+                           (time.time() - self.LOGOUT_RETENTION,))
+            return purge_sessions(cursor, limit)
+
+    def keys(self, since=None):
+        now = int(time.time())
+        with atomic(self.db, readonly=True) as cursor:
+            keys = [row[0] for row in cursor.execute("""
+                SELECT key FROM sessions
+                WHERE started >= ? AND expires > ?
+                """, (since or 0, now))]
+        return keys, now - self.overlap
+
+    def logouts(self, since=None):
+        now = time.time()
+        if since is None:
+            # nothing is cached yet
+            return [], now - self.overlap
+        with atomic(self.db, readonly=True) as cursor:
+            keys = {row[0] for row in cursor.execute(
+                "SELECT key FROM logouts WHERE revoked > ?", (since,))}
+        return keys, now - self.overlap
+
+    def changed(self):
+        # PRAGMA data_version changes when other connections commit
+        if not isinstance(self.db, ConnectionPool):
+            return True
+        connection = self.db.connection()
+        version = connection.execute("PRAGMA data_version").fetchone()[0]
+        seen = getattr(self._seen, 'version', None)
+        self._seen.version = (connection, version)
+        return seen != (connection, version)
+
+    def close(self):
+        if isinstance(self.db, ConnectionPool):
+            self.db.close()
+
+
+class MemorySessionStore(SessionStore):
+    """
+    Sessions kept in a dict, for single process deployments and benchmarks.
+
+    Sessions are lost when the process exits.
+    """
+
+    def __init__(self):
+        self.sessions = {}
+        self.userkeys = {}
+        self._lock = threading.Lock()
+
+    def create(self, userid, lifetime):
+        key = token_urlsafe()
+        digest = session_digest(key)
+        with self._lock:
+            self.sessions[digest] = (userid, time.time() + lifetime)
+            self.userkeys.setdefault(userid, set()).add(digest)
+        return key
+
+    def lookup(self, key):
+        userid, expires = self.sessions.get(session_digest(key), (None, 0.0))
+        return userid if expires > time.time() else None
+
+    def touch(self, key, lifetime):
+        digest = session_digest(key)
+        with self._lock:
+            if digest in self.sessions:
+                self.sessions[digest] = (self.sessions[digest][0],
+                                         time.time() + lifetime)
+
+    def touch_many(self, expiries):
+        with self._lock:
+            for key, expires in expiries:
+                digest = session_digest(key)
+                if digest in self.sessions:
+                    userid, current = self.sessions[digest]
+                    self.sessions[digest] = (userid, max(current, expires))
+
+    def revoke(self, key=None, userid=None):
+        with self._lock:
+            if key is not None:
+                self._discard(session_digest(key))
+            if userid is not None:
+                for digest in list(self.userkeys.get(userid, ())):
+                    self._discard(digest)
+
+    def purge(self, limit=500):
+        now = time.time()
+        with self._lock:
+            expired = [digest for digest, (_, expires)
+                       in self.sessions.items() if expires <= now][:limit]
+            for digest in expired:
+                self._discard(digest)
+        return len(expired)
+
+    def _discard(self, digest):
+        session = self.sessions.pop(digest, None)
+        if session is not None:
+            digests = self.userkeys[session[0]]
+            digests.discard(digest)
+            if not digests:
+                del self.userkeys[session[0]]
+
+    def keys(self, since=None):
+        now = time.time()
+        with self._lock:
+            return [digest for digest, (_, expires)
+                    in self.sessions.items() if expires > now], None
+
+    def changed(self):
+        # only this process creates sessions
+        return False
+
+
+class ProcessThread(ABC):
+    """
+    Runs self.run() in a daemon thread of the calling process.
+
+    start() is cheap enough to call on every request: it starts the thread
+    on first use and again in forked children, which inherit no threads.
+    The thread is stopped when the process exits.
+    """
+
+    name = 'yaap'
+
+    def __init__(self):
+        self.stopped = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """ start the thread unless it runs in this process or was stopped """
+        if self._pid == os.getpid() or self.stopped.is_set():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                self.forked()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self.run, name=self.name,
+                                            daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def forked(self):
+        """ reset state inherited from the parent process """
+
+    @abstractmethod
+    def run(self):
+        """ the body of the thread, returns once self.stopped is set """
+
+    def is_alive(self):
+        return self._pid == os.getpid() and self._thread.is_alive()
+
+    def stop(self):
+        atexit.unregister(self.stop)
+        self.stopped.set()
+
+
+class SessionReaper(ProcessThread):
+    """
+    Background thread calling purge(batch) every interval seconds, until it
+    deletes less than batch expired sessions or revocations.
+    """
+
+    name = 'yaap-reaper'
+
+    def __init__(self, purge, interval=600.0, batch=500):
+        super().__init__()
+        self.purge = purge
+        self.interval = float(interval)
+        self.batch = int(batch)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                # one batch per transaction keeps the write lock short
+                while self.purge(self.batch) >= self.batch:
+                    pass
+            except sqlite3.Error:
+                # database busy or gone: retry next interval
+                pass
+
+
+class SessionToucher(ProcessThread):
+    """
+    Background thread implementing sliding expiry with few writes.
+
+    Requests only record when a session was last seen, the thread extends
+    those sessions to expire lifetime seconds after that in one batched
+    transaction every interval seconds, or sooner once batch sessions are
+    pending. Stopping the thread writes what is left.
+    """
+
+    name = 'yaap-toucher'
+
+    def __init__(self, store, lifetime, interval=60.0, batch=1000):
+        super().__init__()
+        self.store = store
+        self.lifetime = int(lifetime)
+        self.interval = float(interval)
+        self.batch = int(batch)
+        self.pending = {}
+        self.flushes = 0
+        self.flushed = 0
+        self._wakeup = threading.Event()
+        self._pending_lock = threading.Lock()
+
+    def forked(self):
+        # the parent writes its own pending sessions
+        self.pending = {}
+        self._wakeup = threading.Event()
+        self._pending_lock = threading.Lock()
+
+    def touch(self, key):
+        """ record activity of the session key """
+        self.start()
+        with self._pending_lock:
+            self.pending[key] = time.time()
+            full = len(self.pending) >= self.batch
+        if full:
+            self._wakeup.set()
+
+    def flush(self):
+        """ write the pending expiries, return how many were written """
+        with self._pending_lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return 0
+        try:
+            self.store.touch_many((key, seen + self.lifetime)
+                                  for key, seen in pending.items())
+        except sqlite3.Error:
+            # database busy or gone: keep the entries for the next flush
+            with self._pending_lock:
+                for key, seen in pending.items():
+                    if self.pending.get(key, 0) < seen:
+                        self.pending[key] = seen
+            return 0
+        self.flushes += 1
+        self.flushed += len(pending)
+        return len(pending)
+
+    def run(self):
+        while not self.stopped.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def stop(self):
+        super().stop()
+        self._wakeup.set()
+        if self.is_alive():
+            self._thread.join()
+        self.flush()
+
+    def stats(self):
+        return {'pending': len(self.pending), 'flushes': self.flushes,
+                'flushed': self.flushed}
+
+
+# BULK
+def read_users(stream, fmt='csv'):
+    """
+    Yield user dicts from a csv (with header) or jsonl stream.
+
+    Recognized fields are username, email, password or password_hash and
+    groups (a list, or a ';' separated string in csv).
+    """
+    if fmt == 'csv':
+        rows = csv.DictReader(stream)
+    elif fmt == 'jsonl':
+        rows = (json.loads(line) for line in stream if line.strip())
+    else:
+        raise ValueError(f"{fmt!r} is not a valid import format")
+    for row in rows:
+        groups = row.get('groups') or []
+        if isinstance(groups, str):
+            groups = [g for g in groups.split(';') if g]
+        row['groups'] = groups
+        yield row
+
+
+def _check_import_row(row, number):
+    """ raise ValueError unless row can be imported """
+    missing = [field for field in ('username', 'email') if not row.get(field)]
+    if not (row.get('password') or row.get('password_hash')):
+        missing.append('password or password_hash')
+    if missing:
+        raise ValueError(f"row {number} has no {', '.join(missing)}")
+    row.setdefault('groups', [])
+
+
+def import_users(dbfile, rows, chunksize=1000, workers=None, start=0,
+                 progress=None):
+    """
+    Import user dicts in transactions of chunksize rows, return the number
+    of rows imported.
+
+    Plain passwords are hashed in parallel on workers processes. The first
+    start rows are skipped, which resumes an import after a failed chunk.
+    progress(imported, seconds) is called after every committed chunk.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    pool = ConnectionPool(dbfile)
+    rows = itertools.islice(rows, start, None)
+    imported = 0
+    started = time.monotonic()
+    with ProcessPoolExecutor(workers) as executor, closing(pool):
+        with atomic(pool, readonly=True) as cursor:
+            params = hash_params(get_conf(cursor))
+        while True:
+            first = start + imported
+            try:
+                # unreadable and incomplete rows fail the chunk like
+                # database errors do
+                chunk = list(itertools.islice(rows, chunksize))
+                if not chunk:
+                    break
+                for number, row in enumerate(chunk, first):
+                    _check_import_row(row, number)
+                plain = [row for row in chunk
+                         if not row.get('password_hash')]
+                hashes = executor.map(hash_password,
+                                      [row['password'] for row in plain],
+                                      itertools.repeat(params),
+                                      chunksize=max(1, len(plain) // 64))
+                for row, pw_hash in zip(plain, hashes):
+                    row['password_hash'] = pw_hash
+                with atomic(pool) as cursor:
+                    create_users(cursor, chunk)
+            except (sqlite3.Error, ValueError) as e:
+                raise ValueError(
+                    f"Import failed in the chunk starting at row "
+                    f"{first}: {e}") from e
+            imported += len(chunk)
+            if progress:
+                progress(imported, time.monotonic() - started)
+    return imported
+
+
+def create_users(cursor, rows):
+    """ insert already hashed user dicts, their groups and memberships """
+    cursor.executemany(
+        "INSERT INTO users ('username', 'password', 'email') VALUES(?, ?, ?)",
+        ((row['username'], row['password_hash'], row['email'])
+         for row in rows)
+    )
+    groups = {group for row in rows for group in row['groups']}
+    if groups:
+        groups_changed()
+    cursor.executemany(
+        "INSERT OR IGNORE INTO groups ('name') VALUES (?)",
+        ((group,) for group in groups)
+    )
+    cursor.executemany("""
+        INSERT OR IGNORE INTO usergroups ('userid', 'groupid')
+        SELECT users.userid, groups.groupid
+        FROM users, groups
+        WHERE users.username = ? AND groups.name = ?
+        """, ((row['username'], group)
+              for row in rows for group in row['groups'])
+    )
+
+
+def _load_names(cursor, table, names):
+    """ fill the temporary table with the distinct names """
+    cursor.execute(f"CREATE TEMP TABLE IF NOT EXISTS {table}("
+                   f"name TEXT PRIMARY KEY) WITHOUT ROWID")
+    cursor.execute(f"DELETE FROM {table}")
+    cursor.executemany(f"INSERT OR IGNORE INTO {table} VALUES (?)",
+                       ((name,) for name in names))
+
+
+def _members_changed(cursor):
+    # the users loaded in yaap_usernames changed groups
+    members = cursor.execute("""
+        SELECT users.userid, users.username
+        FROM yaap_usernames
+        INNER JOIN users ON users.username = yaap_usernames.name
+        """).fetchall()
+    invalidate_users([username for _, username in members])
+    bump_generation(cursor)
+    # issued tokens carry the old groups
+    revoked = time.time()
+    cursor.executemany(
+        "REPLACE INTO revocations ('userid', 'revoked') VALUES (?, ?)",
+        ((userid, revoked) for userid, _ in members))
+    for revocations in list(RevocationList._instances):
+        for userid, _ in members:
+            revocations.add(userid, revoked)
+
+
+def add_group_members(cursor, group, usernames):
+    """
+    Add the users named in usernames to group (created if needed) in one
+    statement, return the number of memberships added.
+    """
+    _load_names(cursor, 'yaap_usernames', usernames)
+    _members_changed(cursor)
+    cursor.execute("INSERT OR IGNORE INTO groups ('name') VALUES (?)",
+                   (group,))
+    if cursor.rowcount:
+        groups_changed()
+    cursor.execute("""
+        INSERT OR IGNORE INTO usergroups ('userid', 'groupid')
+        SELECT users.userid, groups.groupid
+        FROM yaap_usernames
+        INNER JOIN users ON users.username = yaap_usernames.name
+        INNER JOIN groups ON groups.name = ?
+        """, (group,))
+    return cursor.rowcount
+
+
+def remove_group_members(cursor, group, usernames):
+    """
+    Remove the users named in usernames from group in one statement, return
+    the number of memberships removed.
+    """
+    _load_names(cursor, 'yaap_usernames', usernames)
+    _members_changed(cursor)
+    cursor.execute("""
+        DELETE FROM usergroups
+        WHERE
+            groupid = (SELECT groupid FROM groups WHERE name = ?)
+            AND userid IN (
+                SELECT users.userid
+                FROM yaap_usernames
+                INNER JOIN users ON users.username = yaap_usernames.name
+            )
+        """, (group,))
+    return cursor.rowcount
+
+
+def set_user_groups(cursor, username, groups):
+    """ replace the groups of username by groups, creating missing ones """
+    userid = get_userid(cursor, username)
+    _load_names(cursor, 'yaap_usernames', [username])
+    _load_names(cursor, 'yaap_groupnames', groups)
+    _members_changed(cursor)
+    cursor.execute("INSERT OR IGNORE INTO groups ('name') "
+                   "SELECT name FROM yaap_groupnames")
+    if cursor.rowcount:
+        groups_changed()
+    cursor.execute("""
+        DELETE FROM usergroups
+        WHERE
+            userid = ?
+            AND groupid NOT IN (
+                SELECT groups.groupid
+                FROM yaap_groupnames
+                INNER JOIN groups ON groups.name = yaap_groupnames.name
+            )
+        """, (userid,))
+    cursor.execute("""
+        INSERT OR IGNORE INTO usergroups ('userid', 'groupid')
+        SELECT ?, groups.groupid
+        FROM yaap_groupnames
+        INNER JOIN groups ON groups.name = yaap_groupnames.name
+        """, (userid,))
+
+
+def _pages(dbfile, query, params, pagesize):
+    """
+    Yield the rows of a query keyset paginated on its first column.
+
+    Every page is fetched in its own short read transaction.
+    """
+    last = -1
+    while True:
+        with atomic(dbfile, readonly=True) as cursor:
+            rows = cursor.execute(query, params + (last, pagesize)
+                                  ).fetchall()
+        yield from rows
+        if len(rows) < pagesize:
+            return
+        last = rows[-1][0]
+
+
+def iter_users(dbfile, group=None, pagesize=1000, hashes=False):
+    """ yield user dicts ordered by userid, optionally only those in group """
+    where, params = '', ()
+    if group is not None:
+        where = """
+            users.userid IN (
+                SELECT usergroups.userid
+                FROM usergroups
+                INNER JOIN groups ON groups.groupid = usergroups.groupid
+                WHERE groups.name = ?
+            ) AND"""
+        params = (group,)
+    query = f"""
+        SELECT users.userid, users.username, users.email, users.password,
+               group_concat(groups.name, char(31))
+        FROM users
+        LEFT JOIN usergroups ON usergroups.userid = users.userid
+        LEFT JOIN groups ON groups.groupid = usergroups.groupid
+        WHERE {where} users.userid > ?
+        GROUP BY users.userid
+        ORDER BY users.userid
+        LIMIT ?
+    """
+    for userid, username, email, pw_hash, groups in _pages(
+            dbfile, query, params, pagesize):
+        user = {'userid': userid, 'username': username, 'email': email,
+                'groups': sorted(groups.split('\x1f')) if groups else []}
+        if hashes:
+            user['password_hash'] = pw_hash
+        yield user
+
+
+def iter_groups(dbfile, pagesize=1000):
+    """ yield group dicts ordered by groupid """
+    query = """
+        SELECT groupid, name FROM groups
+        WHERE groupid > ? ORDER BY groupid LIMIT ?
+    """
+    for groupid, name in _pages(dbfile, query, (), pagesize):
+        yield {'groupid': groupid, 'name': name}
+
+
+def iter_sessions(dbfile, group=None, pagesize=1000, session_dbfile=None):
+    """
+    yield session dicts (without their keys) in storage order, read from
+    session_dbfile when sessions are stored separately
+    """
+    if session_dbfile is not None:
+        yield from _iter_split_sessions(dbfile, group, pagesize,
+                                        session_dbfile)
+        return
+    where, params = '', ()
+    if group is not None:
+        where = """
+            sessions.userid IN (
+                SELECT usergroups.userid
+                FROM usergroups
+                INNER JOIN groups ON groups.groupid = usergroups.groupid
+                WHERE groups.name = ?
+            ) AND"""
+        params = (group,)
+    query = f"""
+        SELECT sessions.key, sessions.userid, users.username,
+               datetime(sessions.started, 'unixepoch'),
+               datetime(sessions.expires, 'unixepoch')
+        FROM sessions
+        INNER JOIN users ON users.userid = sessions.userid
+        WHERE {where} sessions.key > ?
+        ORDER BY sessions.key
+        LIMIT ?
+    """
+    for _, userid, username, started, expires in _pages(dbfile, query,
+                                                        params, pagesize):
+        yield {'userid': userid, 'username': username, 'started': started,
+               'expires': expires}
+
+
+def _iter_split_sessions(dbfile, group, pagesize, session_dbfile):
+    query = """
+        SELECT key, userid, datetime(started, 'unixepoch'),
+               datetime(expires, 'unixepoch')
+        FROM sessions
+        WHERE key > ? ORDER BY key LIMIT ?
+    """
+    sessions = _pages(session_dbfile, query, (), pagesize)
+    while True:
+        page = list(itertools.islice(sessions, pagesize))
+        if not page:
+            return
+        params = tuple({row[1] for row in page})
+        marks = ', '.join('?' * len(params))
+        where = ''
+        if group is not None:
+            where = """
+                AND userid IN (
+                    SELECT usergroups.userid
+                    FROM usergroups
+                    INNER JOIN groups ON groups.groupid = usergroups.groupid
+                    WHERE groups.name = ?
+                )"""
+            params += (group,)
+        with atomic(dbfile, readonly=True) as cursor:
+            usernames = dict(cursor.execute(
+                f"SELECT userid, username FROM users "
+                f"WHERE userid IN ({marks}) {where}", params))
+        for _, userid, started, expires in page:
+            if userid in usernames:
+                yield {'userid': userid, 'username': usernames[userid],
+                       'started': started, 'expires': expires}
+
+
+def write_rows(rows, stream, fmt='jsonl'):
+    """ write dicts as jsonl or csv (lists joined with ';') to stream """
+    if fmt == 'jsonl':
+        for row in rows:
+            stream.write(json.dumps(row) + '\n')
+        return
+    writer = None
+    for row in rows:
+        if writer is None:
+            writer = csv.DictWriter(stream, list(row))
+            writer.writeheader()
+        writer.writerow({k: ';'.join(v) if isinstance(v, list) else v
+                         for k, v in row.items()})
+
+
+# BATCH
+def run_command(cursor, command, session_cursor=None):
+    """
+    Run one batch command dict, named by its 'command' key, return a dict
+    with its results.
+
+    create: username, email, password (random if missing), groups
+    update: username, attr, value
+    remove, logout: username
+    configure: key, value
+    """
+    name = command.get('command')
+    if name == 'create':
+        password = command.get('password') or token_urlsafe(8)
+        create_user(cursor, command['username'], password, command['email'],
+                    command.get('groups'))
+        if not command.get('password'):
+            return {'password': password}
+    elif name == 'update':
+        value = command.get('value')
+        if command['attr'] == 'groups':
+            value = set(value or ())
+        update_user(cursor, command['username'], command['attr'], value)
+    elif name == 'remove':
+        if session_cursor is not None:
+            # userids may be reused, do not leave the sessions behind
+            logout_user(cursor, command['username'], session_cursor)
+        remove_user(cursor, command['username'])
+    elif name == 'logout':
+        logout_user(cursor, command['username'], session_cursor)
+    elif name == 'configure':
+        configure(cursor, command['key'], command.get('value'))
+    else:
+        raise ValueError(f"{name!r} is not a valid batch command")
+    return {}
+
+
+def run_batch(db, lines, group=100, session_db=None):
+    """
+    Run jsonl batch commands (see run_command) and yield a result dict for
+    every line.
+
+    db and session_db are paths or ConnectionPools, a path is opened once
+    for the whole batch. Commands run group at a time per transaction, a
+    failing command is rolled back on its own and reported with its error.
+    Results are yielded once their transaction committed.
+    """
+    pools = []
+    if db is not None and not isinstance(db, ConnectionPool):
+        db = ConnectionPool(db)
+        pools.append(db)
+    if session_db is not None and not isinstance(session_db, ConnectionPool):
+        session_db = ConnectionPool(session_db)
+        pools.append(session_db)
+    numbered = enumerate(lines, 1)
+    try:
+        while True:
+            chunk = list(itertools.islice(numbered, group))
+            if not chunk:
+                return
+            results = []
+            with atomic(db) as cursor, \
+                    _optional_atomic(session_db) as session_cursor:
+                for number, line in chunk:
+                    if line.strip():
+                        results.append(_run_line(cursor, session_cursor,
+                                                 number, line))
+            yield from results
+    finally:
+        for pool in pools:
+            pool.close()
+
+
+@contextmanager
+def _optional_atomic(db):
+    if db is None:
+        yield None
+    else:
+        with atomic(db) as cursor:
+            yield cursor
+
+
+def _run_line(cursor, session_cursor, number, line):
+    cursors = [c for c in (cursor, session_cursor) if c is not None]
+    result = {'line': number}
+    for c in cursors:
+        c.execute("SAVEPOINT yaap_command")
+    try:
+        command = json.loads(line)
+        result['command'] = command.get('command')
+        result.update(run_command(cursor, command, session_cursor))
+    except KeyError as e:
+        error = f"missing {e.args[0]!r}"
+    except Exception as e:
+        error = str(e) or type(e).__name__
+    else:
+        error = None
+    for c in cursors:
+        if error is not None:
+            c.execute("ROLLBACK TO yaap_command")
+        c.execute("RELEASE yaap_command")
+    result['ok'] = error is None
+    if error is not None:
+        result['error'] = error
+    return result
+
+
+def batch_server(dbfile, path, session_dbfile=None):
+    """
+    Return a server reading jsonl batch commands from connections to the
+    unix socket at path, answering every line with its result as soon as
+    it is committed. Run it with serve_forever().
+    """
+    import socketserver  # AF_UNIX is POSIX only
+
+    db = ConnectionPool(dbfile)
+    session_db = ConnectionPool(session_dbfile) if session_dbfile else None
+
+    class BatchHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            lines = (line.decode() for line in self.rfile)
+            for result in run_batch(db, lines, 1, session_db):
+                self.wfile.write(json.dumps(result).encode() + b'\n')
+
+    class BatchServer(socketserver.UnixStreamServer):
+        def server_close(self):
+            super().server_close()
+            for pool in (db, session_db):
+                if pool is not None:
+                    pool.close()
+            os.unlink(path)
+
+    # commands run one connection at a time, sqlite has a single writer
+    server = BatchServer(path, BatchHandler, bind_and_activate=False)
+    try:
+        server.server_bind()
+        os.chmod(path, 0o600)
+        server.server_activate()
+    except OSError:
+        server.socket.close()
+        raise
+    return server
+
+
+# TOKENS
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def _signature(secret, payload):
+    return hmac.new(secret.encode(), payload.encode(), hashlib.sha256
+                    ).digest()
+
+
+def issue_token(cursor, username, secret, lifetime=10800):
+    """
+    Return a signed token for username carrying its userid, email, groups,
+    issue time and expiry.
+    """
+    userid = get_userid(cursor, username)
+    user = get_user(cursor, username)
+    issued = time.time()
+    payload = _b64encode(json.dumps({
+        'u': userid, 'n': user.username, 'e': user.email,
+        'g': sorted(user.groups), 'iat': issued, 'exp': issued + lifetime,
+    }, separators=(',', ':')).encode())
+    return payload + '.' + _b64encode(_signature(secret, payload))
+
+
+def verify_token(token, secret):
+    """ return (userid, issue time, User) for a valid token or None """
+    payload, _, signature = token.partition('.')
+    try:
+        valid = hmac.compare_digest(_b64decode(signature),
+                                    _signature(secret, payload))
+        if not valid:
+            return None
+        claims = json.loads(_b64decode(payload))
+    except ValueError:
+        return None
+    if claims['exp'] < time.time():
+        return None
+    return (claims['u'], claims['iat'],
+            User(claims['n'], claims['e'], frozenset(claims['g'])))
+
+
+def encode_cookie(name, value, secret):
+    """ return value followed by a truncated HMAC-SHA256 of name and value """
+    signature = hmac.new(secret.encode(), f'{name}={value}'.encode(),
+                         hashlib.sha256).digest()[:16]
+    return f'{value}.{_b64encode(signature)}'
+
+
+def decode_cookie(name, cookie, secret):
+    """ return the value of an encode_cookie cookie or None if forged """
+    value, _, signature = cookie.rpartition('.')
+    expected = _b64encode(hmac.new(secret.encode(), f'{name}={value}'.encode(),
+                                   hashlib.sha256).digest()[:16])
+    # compare_digest refuses non-ascii strings, no valid signature has them
+    if value and signature.isascii() and hmac.compare_digest(signature,
+                                                             expected):
+        return value
+    return None
+
+
+class RevocationList(object):
+    """
+    In memory copy of the revocations table.
+
+    A token is revoked when it was issued before its user's revocation time.
+    refresh() only loads the revocations added since the previous refresh,
+    looking back overlap seconds for revocations that were stamped before
+    they committed. Revocations made in this process, which add() applies
+    right away, do not move that marker.
+    """
+
+    _instances = weakref.WeakSet()
+
+    def __init__(self, overlap=35.0):
+        self.revoked = {}
+        self.last = 0.0
+        self.overlap = float(overlap)
+        self.refreshed = None
+        self._lock = threading.Lock()
+        RevocationList._instances.add(self)
+
+    def refresh(self, cursor):
+        rows = cursor.execute(
+            "SELECT userid, revoked FROM revocations WHERE revoked > ?",
+            (self.last - self.overlap,)).fetchall()
+        for userid, revoked in rows:
+            self.add(userid, revoked)
+        with self._lock:
+            self.last = max([self.last] + [revoked for _, revoked in rows])
+        self.refreshed = time.monotonic()
+
+    def add(self, userid, revoked):
+        with self._lock:
+            if revoked > self.revoked.get(userid, 0.0):
+                self.revoked[userid] = revoked
+
+    def is_revoked(self, userid, issued):
+        return issued <= self.revoked.get(userid, 0.0)
+
+
+def revoke_user(cursor, username):
+    """ revoke all tokens issued to username until now """
+    revoked = time.time()
+    row = cursor.execute("SELECT userid FROM users WHERE username = ?",
+                         (username,)).fetchone()
+    if row is None:
+        return
+    cursor.execute(
+        "REPLACE INTO revocations ('userid', 'revoked') VALUES (?, ?)",
+        (row[0], revoked)
+    )
+    for revocations in list(RevocationList._instances):
+        revocations.add(row[0], revoked)
+
+
+def purge_revocations(cursor, lifetime=10800, limit=500):
+    """
+    Drop at most limit revocations older than the longest token lifetime,
+    return the number deleted.
+    """
+    cursor.execute("""
+        DELETE FROM revocations
+        WHERE userid IN (
+            SELECT userid FROM revocations
+            WHERE revoked < ?
+            LIMIT ?
+        )
+        """, (time.time() - lifetime, limit))
+    return cursor.rowcount
+
+
 #########
 # MODEL #
 #########
@@ -265,6 +2444,23 @@ class AuthPlugin(object):
     def __init__(self,):
         self.app = None
         self.conf = None
+        self.db = None
+        self.cache = None
+        self.shared = None
+        self.filter = None
+        self.hasher = None
+        self.throttle = None
+        self.revocations = None
+        self.sessions = None
+        self.reaper = None
+        self.toucher = None
+        self.groups = GroupBits()
+        self.generation = None
+        self.generation_checked = 0.0
+        self.logout_marker = None
+        self.db_settings = {}
+        self.lazy_user = LazyUser(self)
+        self.login_link = None
         self.tpls = bottle.BaseTemplate.defaults
 
     def setup(self, app):
@@ -272,78 +2468,433 @@ class AuthPlugin(object):
         self.conf = app.config
         # grab settings from app config
         self.conf.setdefault('auth.dbfile', 'yaap.db')
+        self.conf.setdefault('auth.db_pool', True)
+        self.conf.setdefault('auth.db_journal_mode', 'wal')
+        self.conf.setdefault('auth.db_synchronous', 'normal')
+        self.conf.setdefault('auth.db_cache_size', -8000)
+        self.conf.setdefault('auth.db_mmap_size', 268435456)
+        self.conf.setdefault('auth.db_timeout', 5.0)
+        self.conf.setdefault('auth.session_cache', 0)
+        self.conf.setdefault('auth.session_cache_ttl', 60.0)
+        self.conf.setdefault('auth.shared_cache', None)
+        self.conf.setdefault('auth.shared_cache_slots', 65536)
+        self.conf.setdefault('auth.shared_cache_ttl', 60.0)
+        self.conf.setdefault('auth.cookie_format', 'compact')
+        self.conf.setdefault('auth.cookie_legacy', False)
+        self.conf.setdefault('auth.session_filter', 0)
+        self.conf.setdefault('auth.negative_cache', 4096)
+        self.conf.setdefault('auth.negative_cache_ttl', 30.0)
+        self.conf.setdefault('auth.filter_rebuild', 300.0)
+        self.conf.setdefault('auth.hash_workers', os.cpu_count() or 1)
+        self.conf.setdefault('auth.hash_queue', None)
+        self.conf.setdefault('auth.hash_executor', 'thread')
+        self.conf.setdefault('auth.login_throttle', None)
+        self.conf.setdefault('auth.login_burst', 10)
+        self.conf.setdefault('auth.login_rate', 0.1)
+        self.conf.setdefault('auth.login_addr_burst', 100)
+        self.conf.setdefault('auth.login_addr_rate', 1.0)
+        self.conf.setdefault('auth.session_mode', 'db')
+        self.conf.setdefault('auth.session_store', 'sqlite')
+        self.conf.setdefault('auth.session_dbfile', None)
+        self.conf.setdefault('auth.session_lifetime', 10800)
+        self.conf.setdefault('auth.token_lifetime',
+                             self.conf['auth.session_lifetime'])
+        self.conf.setdefault('auth.reap_interval', 0)
+        self.conf.setdefault('auth.reap_batch', 500)
+        self.conf.setdefault('auth.touch_interval', 0)
+        self.conf.setdefault('auth.touch_batch', 1000)
+        self.conf.setdefault('auth.revocation_refresh', 5.0)
+        self.conf.setdefault('auth.poll_interval', 1.0)
+        self.db = self.open_db(self.conf['auth.dbfile'])
+        if int(self.conf['auth.session_cache']):
+            self.cache = SessionCache(self.conf['auth.session_cache'],
+                                      self.conf['auth.session_cache_ttl'])
+        if self.conf['auth.shared_cache']:
+            self.shared = SharedSessionCache(
+                self.conf['auth.shared_cache'],
+                slots=self.conf['auth.shared_cache_slots'],
+                ttl=self.conf['auth.shared_cache_ttl'])
+        if int(self.conf['auth.hash_workers']):
+            self.hasher = HashPool(self.conf['auth.hash_workers'],
+                                   self.conf['auth.hash_queue'],
+                                   self.conf['auth.hash_executor'])
         try:
-            with atomic(self.conf['auth.dbfile']) as cursor:
+            with atomic(self.db, readonly=True) as cursor:
                 conf = get_conf(cursor)
+                version = schema_version(cursor)
+                if version >= SCHEMA_VERSION:
+                    self.groups.refresh(cursor)
+                    self.generation = get_generation(cursor)
         except sqlite3.OperationalError:
             raise ValueError("You need to init the database or tell the yaap "
                              "plugin where to find your database by specifying"
                              " auth.dbfile in the bottle app config")
-
+        if version < SCHEMA_VERSION:
+            raise ValueError(f"The database schema is outdated (version "
+                             f"{version}, expected {SCHEMA_VERSION}), run "
+                             f"bottle-yaap migrate to upgrade it")
+
+        # settings not given in the app config follow the database
+        self.db_settings = {f'auth.{key}': key for key in conf
+                            if f'auth.{key}' not in self.conf}
+        self.generation_checked = time.monotonic()
         self.conf.setdefault('auth.allow_registration',
                              conf['allow_registration'])
         self.conf.setdefault('auth.cookie_secret', conf['cookie_secret'])
         self.conf.setdefault('auth.cookie_key', conf['cookie_key'])
+        for key in HASH_SETTINGS:
+            self.conf.setdefault(f'auth.{key}', conf[key])
+        self.conf.setdefault('auth.token_secret',
+                             self.conf['auth.cookie_secret'])
+        if self.conf['auth.cookie_format'] not in ('compact', 'legacy'):
+            raise ValueError(f"{self.conf['auth.cookie_format']!r} is not a "
+                             "valid auth.cookie_format")
+        if (self.conf['auth.cookie_format'] == 'legacy'
+                or self.conf['auth.cookie_legacy']) and \
+                self.conf['auth.cookie_secret'] == DEFAULT_COOKIE_SECRET:
+            # bottle unpickles legacy cookies once their signature matches
+            raise ValueError("legacy cookies need a secret auth.cookie_secret")
+        limits = (self.conf['auth.login_burst'], self.conf['auth.login_rate'],
+                  self.conf['auth.login_addr_burst'],
+                  self.conf['auth.login_addr_rate'])
+        if self.conf['auth.login_throttle'] == 'memory':
+            self.throttle = LoginThrottle(*limits)
+        elif self.conf['auth.login_throttle'] == 'sqlite':
+            self.throttle = SQLiteLoginThrottle(self.db, *limits)
+        elif self.conf['auth.login_throttle']:
+            raise ValueError(f"{self.conf['auth.login_throttle']!r} is not a "
+                             "valid auth.login_throttle")
+        if self.conf['auth.session_mode'] == 'token':
+            if self.conf['auth.token_secret'] == DEFAULT_COOKIE_SECRET:
+                # tokens are trusted without a database lookup
+                raise ValueError("auth.session_mode token needs a secret "
+                                 "auth.token_secret or cookie_secret")
+            self.revocations = RevocationList(
+                float(self.conf['auth.db_timeout']) + 30.0)
+            with atomic(self.db, readonly=True) as cursor:
+                self.revocations.refresh(cursor)
+        elif self.conf['auth.session_mode'] != 'db':
+            raise ValueError(f"{self.conf['auth.session_mode']!r} is not a "
+                             "valid auth.session_mode")
+        elif self.conf['auth.session_store'] == 'sqlite':
+            # overlap the busy timeout and some clock skew between hosts
+            self.sessions = SQLiteSessionStore(
+                self.open_session_db(),
+                float(self.conf['auth.db_timeout']) + 30.0)
+        elif self.conf['auth.session_store'] == 'memory':
+            self.sessions = MemorySessionStore()
+        else:
+            raise ValueError(f"{self.conf['auth.session_store']!r} is not a "
+                             "valid auth.session_store")
+        if self.sessions is not None:
+            self.logout_marker = self.sessions.logouts()[1]
+        if self.sessions is not None and int(self.conf['auth.session_filter']):
+            self.filter = SessionFilter(self.sessions,
+                                        self.conf['auth.session_filter'],
+                                        self.conf['auth.negative_cache'],
+                                        self.conf['auth.negative_cache_ttl'],
+                                        self.conf['auth.filter_rebuild'])
+        reap_interval = float(self.conf['auth.reap_interval'])
+        if reap_interval:
+            purge = (self.purge_sessions if self.sessions is not None
+                     else self.purge_revocations)
+            # started by the first request of each (forked) worker
+            self.reaper = SessionReaper(purge,
+                                        self.conf['auth.reap_interval'],
+                                        self.conf['auth.reap_batch'])
+        if self.sessions is not None and \
+                float(self.conf['auth.touch_interval']):
+            self.toucher = SessionToucher(self.sessions,
+                                          self.conf['auth.session_lifetime'],
+                                          self.conf['auth.touch_interval'],
+                                          self.conf['auth.touch_batch'])
         self.conf.setdefault('auth.login', '/login/')
         self.conf.setdefault('auth.logout', '/logout/')
         self.conf.setdefault('auth.register', '/register/')
         self.conf.setdefault('auth.reset', '/reset/')
         self.conf.setdefault('auth.user', '/user/')
 
+        # provide user and login/logout links to bottle templates
+        self.tpls['user'] = TemplateUser()
         self.tpls['auth_user'] = self.conf['auth.user']
+        self.tpls['auth_login'] = self.login_link = AuthLink(self.conf,
+                                                             'auth.login')
+        self.tpls['auth_logout'] = AuthLink(self.conf, 'auth.logout')
+        if self.conf['auth.allow_registration']:
+            self.tpls['auth_register'] = AuthLink(self.conf, 'auth.register')
+
+    def open_db(self, dbfile):
+        """ return a connection pool (or the path) for dbfile """
+        if not self.conf['auth.db_pool']:
+            return dbfile
+        return ConnectionPool(
+            dbfile,
+            journal_mode=self.conf['auth.db_journal_mode'],
+            synchronous=self.conf['auth.db_synchronous'],
+            cache_size=self.conf['auth.db_cache_size'],
+            mmap_size=self.conf['auth.db_mmap_size'],
+            timeout=self.conf['auth.db_timeout'],
+        )
+
+    def open_session_db(self):
+        """ return the database of the sessions table """
+        if not self.conf['auth.session_dbfile']:
+            return self.db
+        db = self.open_db(self.conf['auth.session_dbfile'])
+        try:
+            with atomic(db, readonly=True) as cursor:
+                cursor.execute("SELECT 1 FROM sessions LIMIT 1")
+                version = schema_version(cursor)
+        except sqlite3.OperationalError:
+            raise ValueError("You need to init the session database with "
+                             "bottle-yaap --session-dbfile")
+        if version < SESSION_SCHEMA_VERSION:
+            raise ValueError(f"The session database schema is outdated "
+                             f"(version {version}, expected "
+                             f"{SESSION_SCHEMA_VERSION}), run bottle-yaap "
+                             f"migrate to upgrade it")
+        return db
+
+    def close(self):
+        """ release connections, hash workers and session storage """
+        if self.toucher is not None:
+            # write the last seen times before the connections go
+            self.toucher.stop()
+        if isinstance(self.db, ConnectionPool):
+            self.db.close()
+        if self.hasher is not None:
+            self.hasher.close()
+        if self.reaper is not None:
+            self.reaper.stop()
+        if self.sessions is not None:
+            self.sessions.close()
+        if self.shared is not None:
+            self.shared.close()
+
+    def session_key(self):
+        """ return the session key stored in the request cookie """
+        name = self.conf['auth.cookie_key']
+        if self.conf['auth.cookie_format'] == 'legacy':
+            return bottle.request.get_cookie(
+                name, secret=self.conf['auth.cookie_secret'])
+        cookie = bottle.request.cookies.get(name)
+        if not cookie:
+            return None
+        if cookie.startswith('!') and self.conf['auth.cookie_legacy']:
+            # bottle signed cookie set before switching formats
+            return bottle.request.get_cookie(
+                name, secret=self.conf['auth.cookie_secret'])
+        return decode_cookie(name, cookie, self.conf['auth.cookie_secret'])
+
+    def set_session_cookie(self, session_key):
+        """ store session_key in the response cookie """
+        name = self.conf['auth.cookie_key']
+        if self.conf['auth.cookie_format'] == 'legacy':
+            bottle.response.set_cookie(name, session_key,
+                                       secret=self.conf['auth.cookie_secret'],
+                                       path='/')
+        elif session_key:
+            bottle.response.set_cookie(name, encode_cookie(
+                name, session_key, self.conf['auth.cookie_secret']),
+                path='/')
+        else:
+            bottle.response.set_cookie(name, '', path='/')
 
     def get_user(self):
         """return the currently logged in user associated with this request"""
-        session_key = request.get_cookie(
-            self.conf['auth.cookie_key'],
-            secret=self.conf['auth.cookie_secret']
-        )
+        self.check_generation()
+        if self.reaper is not None:
+            self.reaper.start()
+        session_key = self.session_key()
+        if session_key and self.revocations is not None:
+            return self.get_token_user(session_key)
         if session_key:
-            with atomic(self.conf['auth.dbfile']) as cursor:
-                try:
-                    username, email = next(cursor.execute("""
-                        SELECT username, email
-                        FROM sessions
-                        INNER JOIN users ON users.userid = sessions.userid
-                        WHERE sessions.key = ?
-                        AND sessions.started <= (SELECT
-                                                 datetime('now', '+3 hour'))
-                        """, (session_key,)))
-                except StopIteration:
+            if self.cache is not None:
+                user = self.cache.get(session_key)
+                if user is not None:
+                    if self.toucher is not None:
+                        self.toucher.touch(session_key)
+                    return user
+            user = None
+            if self.shared is not None:
+                user = self.shared.get(session_key, self.generation)
+                if user is not None:
+                    if self.groups.stale:
+                        self.refresh_groups()
+                    user = user._replace(
+                        groupmask=self.groups.mask(user.groups))
+            if user is None:
+                if self.filter is not None and \
+                        not self.filter.might_exist(session_key):
                     return
-                else:
-                    return User(username, email, get_usergroups(cursor, 
-                                                                username))
+                user = self.get_session_user(session_key)
+                if user is None:
+                    if self.filter is not None:
+                        self.filter.reject(session_key)
+                    return
+                if self.shared is not None:
+                    self.shared.set(session_key, user, self.generation)
+            if self.cache is not None:
+                self.cache.set(session_key, user)
+            if self.toucher is not None:
+                self.toucher.touch(session_key)
+            return user
+
+    def check_generation(self):
+        """
+        Reload settings and drop cached users once other processes changed
+        the database, checking at most every auth.poll_interval seconds.
+        Sessions other processes logged out are dropped from the cache.
+        """
+        now = time.monotonic()
+        if now - self.generation_checked < float(
+                self.conf['auth.poll_interval']):
+            return
+        self.generation_checked = now
+        if self.cache is not None and self.sessions is not None:
+            digests, self.logout_marker = self.sessions.logouts(
+                self.logout_marker)
+            if digests:
+                self.cache.invalidate_digests(digests)
+        with atomic(self.db, readonly=True) as cursor:
+            generation = get_generation(cursor)
+            if generation == self.generation:
+                return
+            conf = get_conf(cursor)
+            self.groups.refresh(cursor)
+            if self.revocations is not None:
+                self.revocations.refresh(cursor)
+        self.generation = generation
+        for key, setting in self.db_settings.items():
+            self.conf[key] = conf[setting]
+        if self.cache is not None:
+            self.cache.clear()
+
+    def purge_sessions(self, limit=500):
+        """ delete at most limit expired sessions, return how many """
+        deleted = self.sessions.purge(limit)
+        if self.filter is not None and deleted < limit:
+            # the purge is done: forget its keys and other processes' logouts
+            self.filter.rebuild()
+        return deleted
+
+    def purge_revocations(self, limit=500):
+        """ drop at most limit revocations of expired tokens """
+        with atomic(self.db) as cursor:
+            return purge_revocations(cursor,
+                                     int(self.conf['auth.token_lifetime']),
+                                     limit)
+
+    def refresh_groups(self):
+        """ reload the group name to bit mapping """
+        with atomic(self.db, readonly=True) as cursor:
+            self.groups.refresh(cursor)
+
+    def get_session_user(self, session_key):
+        """ return the user of session_key from the session store """
+        if isinstance(self.sessions, SQLiteSessionStore) and \
+                self.sessions.db is self.db:
+            # sessions live next to the users: resolve both in one query
+            with atomic(self.db, readonly=True) as cursor:
+                return get_session_user(cursor, session_key, self.groups)
+        userid = self.sessions.lookup(session_key)
+        if userid is not None:
+            with atomic(self.db, readonly=True) as cursor:
+                return get_user_by_id(cursor, userid, self.groups)
+
+    def get_token_user(self, token):
+        """ return the user of a signed session token, checked in memory """
+        verified = verify_token(token, self.conf['auth.token_secret'])
+        if verified is None:
+            return
+        userid, issued, user = verified
+        refreshed = self.revocations.refreshed
+        if time.monotonic() - refreshed > float(
+                self.conf['auth.revocation_refresh']):
+            # claim the refresh so concurrent requests skip it
+            self.revocations.refreshed = time.monotonic()
+            with atomic(self.db, readonly=True) as cursor:
+                self.revocations.refresh(cursor)
+        if not self.revocations.is_revoked(userid, issued):
+            if self.groups.stale:
+                self.refresh_groups()
+            return user._replace(groupmask=self.groups.mask(user.groups))
 
     def login(self, username, password):
         """try logging in user, raise ValueError if unsuccessful"""
-        # check whether user + pw match
-        with atomic(self.conf['auth.dbfile']) as cursor:
+        if self.throttle is not None:
+            # shed excess attempts before they cost a hash computation
+            address = bottle.request.environ.get('REMOTE_ADDR')
             try:
-                pw_hash = next(cursor.execute(
-                    "SELECT password FROM users WHERE username = ?",
-                    (username,)))[0]
-            except StopIteration:
-                pass
+                self.throttle.acquire(username, address)
+            except Throttled as e:
+                raise bottle.HTTPError(429, str(e), **{
+                    'Retry-After': str(math.ceil(e.retry_after))})
+        # check whether user + pw match
+        with atomic(self.db, readonly=True) as cursor:
+            row = cursor.execute(
+                "SELECT userid, password FROM users WHERE username = ?",
+                (username,)).fetchone()
+        if row is None:
+            raise ValueError('Invalid username or password.')
+        userid, pw_hash = row
+        self.check_generation()
+        params = hash_params({key: self.conf[f'auth.{key}']
+                              for key in HASH_SETTINGS})
+        try:
+            if self.hasher:
+                valid, new_hash = self.hasher.verify_and_update(
+                    password, pw_hash, params)
             else:
-                if pwd_context.verify(password, pw_hash):
-                    session_key = login_user(cursor, username)
-                    response.set_cookie(
-                        self.conf['auth.cookie_key'], session_key,
-                        secret=self.conf['auth.cookie_secret'], path='/'
-                    )
-                    return
-        raise ValueError('Invalid username or password.')
+                valid, new_hash = verify_and_update(password, pw_hash,
+                                                    params)
+        except Overloaded as e:
+            bottle.abort(503, str(e))
+        if not valid:
+            raise ValueError('Invalid username or password.')
+        if new_hash is not None:
+            # the argon2 parameters changed since the password was hashed
+            with atomic(self.db) as cursor:
+                cursor.execute(
+                    "UPDATE users SET password = ? "
+                    "WHERE userid = ? AND password = ?",
+                    (new_hash, userid, pw_hash))
+
+        if self.revocations is not None:
+            with atomic(self.db, readonly=True) as cursor:
+                session_key = issue_token(
+                    cursor, username, self.conf['auth.token_secret'],
+                    int(self.conf['auth.token_lifetime']))
+        else:
+            session_key = self.sessions.create(
+                userid, int(self.conf['auth.session_lifetime']))
+            if self.filter is not None:
+                self.filter.add(session_key)
+            if self.shared is not None:
+                # write through so sibling workers find the new session
+                with atomic(self.db, readonly=True) as cursor:
+                    user = get_user_by_id(cursor, userid)
+                self.shared.set(session_key, user, self.generation)
+        self.set_session_cookie(session_key)
 
     def logout(self):
         """ log out currently logged in user """
         user = self.get_user()
-        if user:
-            with atomic(self.conf['auth.dbfile']) as cursor:
-                logout_user(cursor, user.username)
-        request.user = self.tpls['user'] = None
-        response.set_cookie(self.conf['auth.cookie_key'], '',
-                            secret=self.conf['auth.cookie_secret'], path='/')
+        # no generation bump: that would empty every process's cache, other
+        # processes find the session in the logouts table when they poll
+        if user and self.revocations is not None:
+            invalidate_user(user.username)
+            with atomic(self.db) as cursor:
+                revoke_user(cursor, user.username)
+        elif user:
+            session_key = self.session_key()
+            if self.cache is not None:
+                self.cache.invalidate(session_key)
+            if self.shared is not None:
+                self.shared.invalidate(session_key)
+            self.sessions.revoke(key=session_key)
+        bottle.request.environ['bottle.request.ext.user'] = None
+        self.set_session_cookie('')
 
     def create(self, username, password, email):
         """ create/register a new user """
@@ -359,42 +2910,78 @@ class AuthPlugin(object):
 
     def apply(self, callback, context):
         """ apply YAAP magic to the route """
-        def wrapper(*args, **kwargs):
-            request.user = self.tpls['user'] = self.get_user()
+        groups = context.config.get('auth', None)
+        lazy_user = self.lazy_user
 
-            # provide login/logout links to bottle templates
-            if request.params.get('from_url'):
-                url = request.params.get('from_url')
-            else:
-                url = request.url
-            from_url = '?from_url=%s' % quote_plus(url)
-            self.tpls['auth_login'] = self.conf['auth.login'] + from_url
-            self.tpls['auth_logout'] = self.conf['auth.logout'] + from_url
-            if self.conf['auth.allow_registration']:
-                self.tpls['auth_register'] = (self.conf['auth.register']
-                                              + from_url)
-
-            # check whether authorization is needed
-            groups = context.config.get('auth', None)
-            if groups is not None:
-                if not request.user:
-                    # need to authorize but not logged in: redirect to login
-                    redirect(self.tpls['auth_login'], 302)
-                elif groups and not groups.intersection(request.user.groups):
-                    # logged in but not authorized
-                    abort(403, 'You do not have sufficient access rights.')
+        if groups is None:
+            # public route: the user is only looked up if the route asks
+            def wrapper(*args, **kwargs):
+                bottle.request.environ['bottle.request.ext.user'] = lazy_user
+                return callback(*args, **kwargs)
+            return wrapper
+
+        required = GroupRequirement(groups, self.groups, self.refresh_groups)
+        login_link = self.login_link
+
+        def wrapper(*args, **kwargs):
+            user = self.get_user()
+            bottle.request.environ['bottle.request.ext.user'] = user
+            if not user:
+                # need to authorize but not logged in: redirect to login
+                bottle.redirect(str(login_link), 302)
+            elif groups and not required.allows(user.groupmask):
+                # logged in but not authorized
+                bottle.abort(403, 'You do not have sufficient access rights.')
 
             # render route as normal
             return callback(*args, **kwargs)
         return wrapper
 
 
+class LazyUser(object):
+    """ request.user value that resolves the session on first access """
+
+    def __init__(self, plugin):
+        self.plugin = plugin
+
+    def __get__(self, req, owner=None):
+        user = self.plugin.get_user()
+        req.environ['bottle.request.ext.user'] = user
+        return user
+
+
+class TemplateUser(object):
+    """ template stand-in for the user of the current request """
+
+    def __bool__(self):
+        return bool(getattr(bottle.request, 'user', None))
+
+    def __getattr__(self, name):
+        return getattr(getattr(bottle.request, 'user', None), name)
+
+    def __str__(self):
+        return str(getattr(bottle.request, 'user', None))
+
+
+class AuthLink(object):
+    """ link to an auth page returning to the current url, built on use """
+
+    def __init__(self, conf, key):
+        self.conf = conf
+        self.key = key
+
+    def __str__(self):
+        url = bottle.request.params.get('from_url') or bottle.request.url
+        return '%s?from_url=%s' % (self.conf[self.key], quote_plus(url))
+
+
 def json_app(config):
     """
     Example json REST API app.
 
     :config: dict
     """
+    from bottle import request, response
     app = bottle.Bottle()
     app.config.load_dict(config)
     auth = AuthPlugin()
@@ -422,6 +3009,7 @@ def html_app(config):
 
     :config: dict
     """
+    from bottle import request, view, redirect, template
     app = bottle.Bottle()
     app.config.load_dict(config)
     auth = AuthPlugin()
@@ -581,18 +3169,33 @@ action="{{auth_logout}}">
 """
 }
 
-try:
-    import click
-except ImportError:
-    def cli(*args, **kwargs):
-        print("Could not import click.")
-else:
+
+@functools.lru_cache(maxsize=None)
+def _build_cli():
+    """
+    Define the click commands. Click is imported here rather than with the
+    module, and commands only load bottle or passlib when they need them.
+    """
+    try:
+        import click
+    except ImportError:
+        def cli(*args, **kwargs):
+            print("Could not import click.")
+        return cli
+
     @click.group()
     @click.option('--dbfile', '-db', default='yaap.db', help="database file")
+    @click.option('--session-dbfile', '-sdb', default=None,
+                  help="separate session database file")
     @click.pass_context
-    def cli(ctx, dbfile):
+    def cli(ctx, dbfile, session_dbfile):
         """ edit YAAP database """
         ctx.obj = dbfile
+        ctx.meta['yaap.session_dbfile'] = session_dbfile
+
+    def cli_session_dbfile():
+        """ return the separate session database file, if any """
+        return click.get_current_context().meta['yaap.session_dbfile']
 
     @cli.command('init')
     @click.option('--demo/--empty', default=False)
@@ -606,8 +3209,26 @@ else:
                 create_user(cursor, 'special_tester', 'pw',
                             'special_tester@somnolentia.net',
                             groups=['special'])
+        if cli_session_dbfile():
+            with atomic(cli_session_dbfile()) as cursor:
+                create_session_tables(cursor)
 
-
+    @cli.command('migrate')
+    @click.pass_obj
+    def cli_migrate(dbfile):
+        """ upgrade the database schema to the latest version """
+        databases = [(dbfile, MIGRATIONS)]
+        if cli_session_dbfile():
+            databases.append((cli_session_dbfile(), SESSION_MIGRATIONS))
+        for db, migrations in databases:
+            with atomic(db, readonly=True) as cursor:
+                current = schema_version(cursor)
+            # one transaction per step keeps the write lock short
+            for version in range(current, len(migrations)):
+                with atomic(db) as cursor:
+                    migrate(cursor, version + 1, migrations)
+                click.echo(f"Migrated {db} to version {version + 1}")
+            click.echo(f"{db} schema is at version {len(migrations)}")
 
     @cli.command('configure')
     @click.argument('key')
@@ -616,8 +3237,34 @@ else:
     def cli_configure(dbfile, key, value):
         """ configure YAAP """
         value = None if value == 'NULL' else value
+        try:
+            with atomic(dbfile) as cursor:
+                configure(cursor, key, value)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+
+    @cli.command('calibrate')
+    @click.option('--latency', default=0.5,
+                  help="seconds a login may spend verifying the password")
+    @click.option('--concurrency', type=int,
+                  help="logins verified at once (default: number of cpus)")
+    @click.option('--max-memory', default=1024,
+                  help="MiB all concurrent logins may use together")
+    @click.option('--dry-run', is_flag=True,
+                  help="only show the parameters, do not store them")
+    @click.pass_obj
+    def cli_calibrate(dbfile, latency, concurrency, max_memory, dry_run):
+        """ tune the argon2 parameters to this machine """
+        params, seconds = calibrate(latency, concurrency, max_memory * 1024)
+        click.echo(' '.join(f'{name}={value}'
+                            for name, value in params.items()) +
+                   f" ({seconds * 1000:.0f} ms per hash)")
+        if dry_run:
+            return
         with atomic(dbfile) as cursor:
-            configure(cursor, key, value)
+            for name, value in params.items():
+                configure(cursor, f'argon2_{name}', value)
+        click.echo("Stored, passwords are rehashed when their users log in")
 
     @cli.command('create')
     @click.argument('username')
@@ -632,11 +3279,42 @@ else:
                         email=email, groups=group)
         click.echo(f"Created user {username!r} with password {password!r}")
 
+    @cli.command('import')
+    @click.argument('source', type=click.File('r'), default='-')
+    @click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']),
+                  help="input format (default: from file extension, csv)")
+    @click.option('--chunk-size', default=1000, help="rows per transaction")
+    @click.option('--workers', type=int, help="password hashing processes")
+    @click.option('--start', default=0, help="number of rows to skip")
+    @click.pass_obj
+    def cli_import(dbfile, source, fmt, chunk_size, workers, start):
+        """ import users from a csv or jsonl file (or stdin) """
+        if fmt is None:
+            fmt = 'jsonl' if source.name.endswith('.jsonl') else 'csv'
+
+        def progress(imported, seconds):
+            click.echo(f"{start + imported} rows imported "
+                       f"({imported / seconds:.0f} rows/s)", err=True)
+
+        try:
+            imported = import_users(dbfile, read_users(source, fmt),
+                                    chunksize=chunk_size, workers=workers,
+                                    start=start, progress=progress)
+        except ValueError as e:
+            raise click.ClickException(
+                f"{e}\nFix the input and resume with --start set to that row.")
+        click.echo(f"Imported {imported} users")
+
     @cli.command('remove')
     @click.argument('username')
     @click.pass_obj
     def cli_remove(dbfile, username):
         """ remove existing user """
+        if cli_session_dbfile():
+            # userids may be reused, do not leave the session behind
+            with atomic(dbfile) as cursor, \
+                    atomic(cli_session_dbfile()) as session_cursor:
+                logout_user(cursor, username, session_cursor)
         with atomic(dbfile) as cursor:
             remove_user(cursor, username=username)
         click.echo(f"Deleted user {username!r}")
@@ -659,32 +3337,145 @@ else:
             update_user(cursor, username, attr, value)
         click.echo(f"Updated user {username!r}")
 
+    @cli.group('group')
+    @click.pass_obj
+    def cli_group(dbfile):
+        """ manage group memberships """
+        pass
+
+    def cli_usernames(usernames, source):
+        """ usernames given as arguments and, one per line, in source """
+        usernames = list(usernames)
+        if source is not None:
+            usernames.extend(line.strip() for line in source if line.strip())
+        return usernames
+
+    @cli_group.command('add')
+    @click.argument('group')
+    @click.argument('usernames', nargs=-1)
+    @click.option('--file', '-f', 'source', type=click.File('r'),
+                  help="file with one username per line ('-' for stdin)")
+    @click.pass_obj
+    def cli_group_add(dbfile, group, usernames, source):
+        """ add users to a group """
+        with atomic(dbfile) as cursor:
+            added = add_group_members(cursor, group,
+                                      cli_usernames(usernames, source))
+        click.echo(f"Added {added} users to group {group!r}")
+
+    @cli_group.command('remove')
+    @click.argument('group')
+    @click.argument('usernames', nargs=-1)
+    @click.option('--file', '-f', 'source', type=click.File('r'),
+                  help="file with one username per line ('-' for stdin)")
+    @click.pass_obj
+    def cli_group_remove(dbfile, group, usernames, source):
+        """ remove users from a group """
+        with atomic(dbfile) as cursor:
+            removed = remove_group_members(cursor, group,
+                                           cli_usernames(usernames, source))
+        click.echo(f"Removed {removed} users from group {group!r}")
+
     @cli.command('logout')
     @click.argument('username')
     @click.pass_obj
     def cli_logout(dbfile, username):
         """ log out user """
-        with atomic(dbfile) as cursor:
-            logout_user(cursor, username)
+        if cli_session_dbfile():
+            with atomic(dbfile) as cursor, \
+                    atomic(cli_session_dbfile()) as session_cursor:
+                logout_user(cursor, username, session_cursor)
+        else:
+            with atomic(dbfile) as cursor:
+                logout_user(cursor, username)
         click.echo(f"User {username!r} is now logged out.")
 
+    @cli.command('batch')
+    @click.argument('source', type=click.File('r'), default='-')
+    @click.option('--group', default=100, help="commands per transaction")
+    @click.pass_obj
+    def cli_batch(dbfile, source, group):
+        """ run jsonl commands, print jsonl results """
+        stdout = click.get_text_stream('stdout')
+        for result in run_batch(dbfile, source, group, cli_session_dbfile()):
+            stdout.write(json.dumps(result) + '\n')
+
+    @cli.command('serve')
+    @click.argument('socket')
+    @click.pass_obj
+    def cli_serve(dbfile, socket):
+        """ run jsonl commands sent to a unix socket """
+        server = batch_server(dbfile, socket, cli_session_dbfile())
+        click.echo(f"Listening on {socket}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+    @cli.group('sessions')
+    @click.pass_obj
+    def cli_sessions(dbfile):
+        """ manage sessions """
+        pass
+
+    @cli_sessions.command('purge')
+    @click.option('--batch', default=500, help="sessions per transaction")
+    @click.pass_obj
+    def cli_sessions_purge(dbfile, batch):
+        """ delete expired sessions """
+        deleted = reap_sessions(cli_session_dbfile() or dbfile, batch)
+        click.echo(f"Deleted {deleted} expired sessions")
+
     @cli.group('show')
     @click.pass_obj
     def cli_show(dbfile):
         """ show various information """
         pass
 
+    @cli_show.command('users')
+    @click.option('--group', '-g', help="only show members of this group")
+    @click.option('--format', 'fmt', type=click.Choice(['jsonl', 'csv']),
+                  default='jsonl')
+    @click.option('--hashes', is_flag=True, help="include password hashes")
+    @click.pass_obj
+    def cli_show_users(dbfile, group, fmt, hashes):
+        """ stream all users """
+        write_rows(iter_users(dbfile, group=group, hashes=hashes),
+                   click.get_text_stream('stdout'), fmt)
+
+    @cli_show.command('groups')
+    @click.option('--format', 'fmt', type=click.Choice(['jsonl', 'csv']),
+                  default='jsonl')
+    @click.pass_obj
+    def cli_show_groups(dbfile, fmt):
+        """ stream all groups """
+        write_rows(iter_groups(dbfile), click.get_text_stream('stdout'), fmt)
+
+    @cli_show.command('sessions')
+    @click.option('--group', '-g', help="only show members of this group")
+    @click.option('--format', 'fmt', type=click.Choice(['jsonl', 'csv']),
+                  default='jsonl')
+    @click.pass_obj
+    def cli_show_sessions(dbfile, group, fmt):
+        """ stream all sessions """
+        write_rows(iter_sessions(dbfile, group=group,
+                                 session_dbfile=cli_session_dbfile()),
+                   click.get_text_stream('stdout'), fmt)
+
     @cli_show.command('settings')
     @click.pass_obj
     def cli_show_settings(dbfile):
         """ show current settings """
-        with atomic(dbfile) as cursor:
+        with atomic(dbfile, readonly=True) as cursor:
             print(get_conf(cursor))
 
     @cli.command('demo')
     @click.pass_obj
     def cli_demo(dbfile):
         """ run demo web app """
+        from bottle import view, template
         bottle.debug(True)
         config = {'auth': {'dbfile': dbfile}}
         app = html_app(config)
@@ -719,3 +3510,5 @@ else:
         # jsonapp = json_app(config)
         # app.mount('/api/', jsonapp)
         bottle.run(app, reloader=True, port="8000")
+
+    return cli
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+"""
+Startup time of bottle_yaap, the cost every worker boot and every
+bottle-yaap call pays before doing anything useful.
+
+    python tests/bench_startup.py [runs]
+"""
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CASES = [
+    ('python', 'pass'),
+    ('import bottle_yaap', 'import bottle_yaap'),
+    ('bottle-yaap --help',
+     "import bottle_yaap; bottle_yaap.cli(['--help'], standalone_mode=False)"),
+    ('import with bottle', 'import bottle_yaap; bottle_yaap.bottle.Bottle'),
+]
+
+
+def measure(code, runs):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], env=env, check=True,
+                       stdout=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+
+def main(runs=20):
+    for name, code in CASES:
+        print(f"{name:<24} {measure(code, runs) * 1000:7.1f} ms")
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
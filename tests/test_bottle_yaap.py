@@ -1,9 +1,42 @@
 #!/usr/bin/env python3
 # -*- coding: UTF-8 -*-
+import base64
+import hashlib
+import hmac
+import io
+import json
+import os
+import pickle
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from wsgiref.util import setup_testing_defaults
 import pytest
+from click.testing import CliRunner
+from bottle import request
 from bottle_yaap import (create_tables, atomic, create_user, create_usergroup, 
                          remove_user, remove_usergroup, update_user,
-                         get_usergroups)
+                         get_usergroups, ConnectionPool, SessionCache, User,
+                         json_app, html_app, get_user, get_session_user,
+                         login_user, HashPool, Overloaded, issue_token,
+                         verify_token, logout_user, import_users, read_users,
+                         hash_password, cli, iter_users, iter_groups,
+                         iter_sessions, write_rows, reap_sessions,
+                         schema_version, SCHEMA_VERSION,
+                         SESSION_SCHEMA_VERSION, SessionStore,
+                         MemorySessionStore, SQLiteSessionStore,
+                         SharedSessionCache, BloomFilter,
+                         SessionFilter, encode_cookie, decode_cookie,
+                         SessionToucher, session_digest, LoginThrottle,
+                         SQLiteLoginThrottle, Throttled, calibrate,
+                         get_generation, create_session, configure, get_conf,
+                         add_group_members, remove_group_members,
+                         set_user_groups, create_users, users_in_group,
+                         run_batch, batch_server, RevocationList,
+                         revoke_user, GroupBits)
 
 
 @pytest.fixture
@@ -14,6 +47,61 @@ def dbfile(tmpdir):
     return dbfile 
 
 
+def make_app(dbfile, **conf):
+    with atomic(dbfile) as cursor:
+        create_user(cursor, username='pieter', password='123abc',
+                    email='p@i.org', groups=['testers'])
+    conf.setdefault('session_cache', 16)
+    app = json_app({'auth': dict(conf, dbfile=dbfile)})
+
+    @app.get('/whoami/', auth=set())
+    def whoami():
+        return {'username': request.user.username,
+                'groups': sorted(request.user.groups)}
+
+    @app.get('/testers/', auth={'testers'})
+    def testers():
+        return {}
+
+    return app
+
+
+@pytest.fixture
+def app(dbfile):
+    app = make_app(dbfile)
+    yield app
+    app.close()
+
+
+def call(app, path, method='GET', cookie=None, body=None):
+    """ call the wsgi app, return status, cookie header and body """
+    environ = {}
+    setup_testing_defaults(environ)
+    environ.update(PATH_INFO=path, REQUEST_METHOD=method)
+    if cookie:
+        environ['HTTP_COOKIE'] = cookie
+    if body is not None:
+        data = json.dumps(body).encode()
+        environ.update({'CONTENT_TYPE': 'application/json',
+                        'CONTENT_LENGTH': str(len(data)),
+                        'wsgi.input': io.BytesIO(data)})
+    status, headers = [], []
+
+    def start_response(s, h, exc_info=None):
+        status.append(s)
+        headers.extend(h)
+    body = b''.join(app(environ, start_response))
+    cookies = [v.split(';')[0] for k, v in headers if k == 'Set-Cookie']
+    return int(status[0][:3]), (cookies[0] if cookies else None), body
+
+
+def login(app, username='pieter', password='123abc'):
+    status, cookie, _ = call(app, '/login/', 'POST',
+                             body={'username': username, 'password': password})
+    assert status == 200
+    return cookie
+
+
 def test_create_user(dbfile):
     with atomic(dbfile) as cursor:
         create_user(cursor, username='pieter', password='123abc', 
@@ -65,6 +153,25 @@ def test_remove_user(dbfile):
         assert len(usergroups) == 0
 
 
+def test_remove_user_groups(dbfile):
+    with atomic(dbfile) as cursor:
+        create_user(cursor, username='pieter', password='123abc',
+                    email='p@i.org', groups=['testers', 'happy'])
+        create_user(cursor, username='jan', password='123abc',
+                    email='j@i.org', groups=['testers', 'empty'])
+        remove_usergroup(cursor, 'jan', 'empty')
+        assert users_in_group(cursor, 'testers') == {'pieter', 'jan'}
+        plan = ' '.join(row[-1] for row in cursor.execute(
+            "EXPLAIN QUERY PLAN SELECT userid FROM usergroups "
+            "WHERE groupid = 1"))
+        assert 'idx_usergroups_groupid' in plan
+        remove_user(cursor, 'pieter')
+        assert users_in_group(cursor, 'testers') == {'jan'}
+        # orphans of other users are not collected
+        groups = {row[0] for row in cursor.execute("SELECT name FROM groups")}
+        assert groups == {'testers', 'empty'}
+
+
 def test_remove_usergroup(dbfile):
     with atomic(dbfile) as cursor:
         create_user(cursor, username='pieter', password='123abc', 
@@ -104,3 +211,907 @@ def test_update_user(dbfile):
         # test setting usergroups
         update_user(cursor, 'tester', 'groups', {'a', 'b', 'c'})
         assert get_usergroups(cursor, 'tester') == {'a', 'b', 'c'} 
+
+
+def test_connection_pool(dbfile):
+    pool = ConnectionPool(dbfile)
+    with atomic(pool) as cursor:
+        create_user(cursor, username='pieter', password='123abc', 
+                    email='p@i.org')
+    with atomic(pool, readonly=True) as cursor:
+        assert cursor.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+        assert cursor.execute("SELECT count(*) FROM users").fetchone()[0] == 1
+    # one connection per thread, reused across transactions
+    assert pool.connection() is pool.connection()
+    other = []
+    thread = threading.Thread(target=lambda: other.append(pool.connection()))
+    thread.start()
+    thread.join()
+    assert other[0] is not pool.connection()
+    # connections of finished threads are not kept open
+    del other
+    threads = [threading.Thread(target=pool.connection) for _ in range(50)]
+    for thread in threads:
+        thread.start()
+        thread.join()
+    assert len(pool._connections) <= 2
+    pool.close()
+
+
+def test_atomic_rollback(dbfile):
+    pool = ConnectionPool(dbfile)
+    with pytest.raises(RuntimeError):
+        with atomic(pool) as cursor:
+            create_user(cursor, username='pieter', password='123abc', 
+                        email='p@i.org')
+            raise RuntimeError
+    with atomic(pool) as cursor:
+        assert cursor.execute("SELECT count(*) FROM users").fetchone()[0] == 0
+    pool.close()
+
+
+@pytest.mark.parametrize('pooled', [False, True])
+def test_atomic_readonly(dbfile, pooled):
+    db = ConnectionPool(dbfile) if pooled else dbfile
+    with pytest.raises(sqlite3.OperationalError, match='readonly'):
+        with atomic(db, readonly=True) as cursor:
+            cursor.execute("DELETE FROM users")
+    # the pooled connection can write again afterwards
+    with atomic(db) as cursor:
+        create_user(cursor, username='pieter', password='123abc',
+                    email='p@i.org')
+    with atomic(db, readonly=True) as cursor:
+        assert cursor.execute("SELECT count(*) FROM users").fetchone()[0] == 1
+    if pooled:
+        db.close()
+
+
+def test_session_cache():
+    cache = SessionCache(maxsize=2, ttl=60)
+    pieter = User('pieter', 'p@i.org', frozenset())
+    cache.set('a', pieter)
+    cache.set('b', User('jan', 'j@i.org', frozenset()))
+    assert cache.get('a') == pieter
+    cache.set('c', User('piet', 'q@i.org', frozenset()))
+    # 'b' was least recently used
+    assert cache.get('b') is None
+    cache.invalidate_user('pieter')
+    assert cache.get('a') is None
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 2
+    cache.ttl = -1
+    cache.set('d', pieter)
+    assert cache.get('d') is None
+
+
+def test_plugin_session_cache(app, dbfile):
+    cookie = login(app)
+    status, _, body = call(app, '/whoami/', cookie=cookie)
+    assert status == 200
+    assert json.loads(body) == {'username': 'pieter', 'groups': ['testers']}
+    auth = app.plugins[-1]
+    assert len(auth.cache) == 1
+    # updates through the module helpers invalidate the cache
+    with atomic(dbfile) as cursor:
+        update_user(cursor, 'pieter', 'groups', {'other'})
+    assert len(auth.cache) == 0
+    assert call(app, '/testers/', cookie=cookie)[0] == 403
+    # logging out a single session leaves other processes' caches alone
+    with atomic(dbfile) as cursor:
+        generation = get_generation(cursor)
+    call(app, '/logout/', 'POST', cookie=cookie)
+    with atomic(dbfile) as cursor:
+        assert get_generation(cursor) == generation
+    assert call(app, '/whoami/', cookie=cookie)[0] == 302
+
+
+def test_logout_other_worker(dbfile):
+    worker = make_app(dbfile, poll_interval=0)
+    other = json_app({'auth': {'dbfile': dbfile, 'session_cache': 16,
+                               'poll_interval': 0}})
+
+    @other.get('/whoami/', auth=set())
+    def whoami():
+        return request.user.username
+
+    cookie = login(worker)
+    assert call(other, '/whoami/', cookie=cookie)[0] == 200
+    assert len(other.plugins[-1].cache) == 1
+    call(worker, '/logout/', 'POST', cookie=cookie)
+    assert call(other, '/whoami/', cookie=cookie)[0] == 302
+    worker.close()
+    other.close()
+
+
+def test_get_user(dbfile):
+    with atomic(dbfile) as cursor:
+        create_user(cursor, username='pieter', password='123abc', 
+                    email='p@i.org', groups=['testers', 'happy'])
+        create_user(cursor, username='jan', password='123abc', 
+                    email='j@i.org')
+
+    with atomic(dbfile) as cursor:
+        assert get_user(cursor, 'pieter') == ('pieter', 'p@i.org',
+                                              {'testers', 'happy'}, 0)
+        # bits are dense, whatever the groupids
+        cursor.execute("INSERT INTO groups VALUES (50000, 'big')")
+        cursor.execute("INSERT INTO usergroups VALUES (1, 50000)")
+        bits = GroupBits()
+        assert get_user(cursor, 'pieter', bits).groupmask == 0b111
+        assert bits.mask({'big'}) == 0b100
+        assert get_user(cursor, 'jan', bits) == ('jan', 'j@i.org', set(), 0)
+        with pytest.raises(LookupError):
+            get_user(cursor, 'piet')
+        key = login_user(cursor, 'pieter')
+        assert get_session_user(cursor, key) == get_user(cursor, 'pieter')
+        assert get_session_user(cursor, 'nope') is None
+
+
+def test_lazy_user(app, monkeypatch):
+    cookie = login(app)
+    auth = app.plugins[-1]
+    lookups = []
+    monkeypatch.setattr(auth, 'get_user',
+                        lambda: lookups.append(1) or User('x', 'y', set()))
+
+    @app.get('/health/')
+    def health():
+        return 'ok'
+
+    @app.get('/me/')
+    def me():
+        return request.user.username
+
+    assert call(app, '/health/', cookie=cookie)[2] == b'ok'
+    assert lookups == []
+    assert call(app, '/me/', cookie=cookie)[2] == b'x'
+    assert lookups == [1]
+
+
+def test_html_app(dbfile):
+    with atomic(dbfile) as cursor:
+        create_user(cursor, username='pieter', password='123abc',
+                    email='p@i.org')
+    app = html_app({'auth': {'dbfile': dbfile}})
+    status, _, body = call(app, '/login/')
+    assert b'action="/login/?from_url=http%3A%2F%2F127.0.0.1%2Flogin%2F"' in body
+    status, _, _ = call(app, '/user/')
+    assert status == 302
+    status, _, body = call(app, '/login/', 'POST', body={})
+    assert b'Invalid username or password.' in body
+    app.close()
+
+
+def test_hash_pool():
+    pool = HashPool(workers=1, max_queue=1)
+    pw_hash = pool.hash('pw')
+    assert pool.verify('pw', pw_hash)
+    assert not pool.verify('nope', pw_hash)
+    assert pool.stats()['completed'] == 3
+
+    # a full queue fails fast
+    release = threading.Event()
+    thread = threading.Thread(target=pool.submit, args=(release.wait,))
+    thread.start()
+    while not pool.pending:
+        pass
+    with pytest.raises(Overloaded):
+        pool.verify('pw', pw_hash)
+    release.set()
+    thread.join()
+    assert pool.stats()['rejected'] == 1
+    assert pool.stats()['pending'] == 0
+    pool.close()
+
+
+def test_tokens(dbfile):
+    with atomic(dbfile) as cursor:
+        create_user(cursor, username='pieter', password='123abc', 
+                    email='p@i.org', groups=['testers'])
+        token = issue_token(cursor, 'pieter', 'secret')
+        expired = issue_token(cursor, 'pieter', 'secret', lifetime=-1)
+    userid, issued, user = verify_token(token, 'secret')
+    assert user[:3] == ('pieter', 'p@i.org', {'testers'})
+    assert verify_token(token, 'other secret') is None
+    assert verify_token(token[:-2], 'secret') is None
+    assert verify_token('garbage', 'secret') is None
+    assert verify_token(expired, 'secret') is None
+
+
+def test_revocation_list(dbfile):
+    with atomic(dbfile) as cursor:
+        create_user(cursor, username='x', password='pw', email='x@i.org')
+        create_user(cursor, username='y', password='pw', email='y@i.org')
+    revocations = RevocationList()
+    with atomic(dbfile, readonly=True) as cursor:
+        revocations.refresh(cursor)
+    issued = time.time() - 1
+    # another process revokes x, then this one revokes y
+    with sqlite3.connect(dbfile) as connection:
+        connection.execute("INSERT INTO revocations VALUES (1, ?)",
+                           (time.time(),))
+    with atomic(dbfile) as cursor:
+        revoke_user(cursor, 'y')
+    assert revocations.is_revoked(2, issued)
+    assert not revocations.is_revoked(1, issued)
+    with atomic(dbfile, readonly=True) as cursor:
+        revocations.refresh(cursor)
+    assert revocations.is_revoked(1, issued)
+
+
+def test_group_changes_revoke_tokens(dbfile):
+    revocations = RevocationList()
+    issued = time.time() - 1
+    with atomic(dbfile) as cursor:
+        create_user(cursor, username='u', password='pw', email='u@i.org',
+                    groups=['admin'])
+        assert not revocations.is_revoked(1, issued)
+        remove_usergroup(cursor, 'u', 'admin')
+        assert revocations.is_revoked(1, issued)
+        create_user(cursor, username='v', password='pw', email='v@i.org')
+        create_usergroup(cursor, 'v', 'admin')
+        assert revocations.is_revoked(2, issued)
+
+
+def test_plugin_token_sessions(dbfile):
+    # tokens signed with the public default secret could be forged
+    with pytest.raises(ValueError, match='token_secret'):
+        json_app({'auth': {'dbfile': dbfile, 'session_mode': 'token'}})
+    app = make_app(dbfile, session_mode='token', session_cache=0,
+                   token_secret='not the default')
+    auth = app.plugins[-1]
+    with atomic(dbfile) as cursor:
+        cursor.execute("INSERT INTO revocations VALUES (99, 0)")
+    assert auth.purge_revocations() == 1
+    cookie = login(app)
+    assert call(app, '/testers/', cookie=cookie)[0] == 200
+    # changing groups revokes issued tokens
+    with atomic(dbfile) as cursor:
+        update_user(cursor, 'pieter', 'groups', {'other'})
+    assert call(app, '/whoami/', cookie=cookie)[0] == 302
+    cookie = login(app)
+    status, _, body = call(app, '/whoami/', cookie=cookie)
+    assert json.loads(body)['groups'] == ['other']
+    call(app, '/logout/', 'POST', cookie=cookie)
+    assert call(app, '/whoami/', cookie=cookie)[0] == 302
+    app.close()
+
+
+def test_import_users(dbfile):
+    rows = read_users(io.StringIO(
+        'username,email,password,groups\n'
+        'pieter,p@i.org,123abc,testers;happy\n'
+        'jan,j@i.org,pw,\n'
+        'jan,j@i.org,pw,\n'
+        'piet,q@i.org,pw,happy\n'
+    ))
+    with pytest.raises(ValueError, match='starting at row 2'):
+        import_users(dbfile, rows, chunksize=2, workers=1)
+    with atomic(dbfile) as cursor:
+        assert get_user(cursor, 'pieter').groups == {'testers', 'happy'}
+        assert cursor.execute("SELECT count(*) FROM users").fetchone()[0] == 2
+
+    rows = read_users(io.StringIO(
+        '{"username": "piet", "email": "q@i.org", "groups": ["happy"], '
+        '"password_hash": "%s"}\n' % hash_password('pw')
+    ), 'jsonl')
+    assert import_users(dbfile, rows, workers=1) == 1
+    with atomic(dbfile) as cursor:
+        assert get_user(cursor, 'piet').groups == {'happy'}
+
+    # incomplete and unreadable rows are reported like database errors
+    rows = read_users(io.StringIO(
+        'username,email,password\n'
+        'kees,k@i.org,pw\n'
+        'klaas,,pw\n'
+    ))
+    with pytest.raises(ValueError, match='starting at row 0: row 1 has no '
+                                         'email'):
+        import_users(dbfile, rows, workers=1)
+    rows = read_users(io.StringIO(
+        '{"username": "kees", "email": "k@i.org", "password": "pw"}\n'
+        '{"username"\n'
+    ), 'jsonl')
+    with pytest.raises(ValueError, match='starting at row 1'):
+        import_users(dbfile, rows, chunksize=1, workers=1)
+
+
+def test_cli_import(dbfile):
+    result = CliRunner().invoke(
+        cli, ['-db', dbfile, 'import', '--workers', '1', '--start', '1'],
+        input='username,email,password\njan,j@i.org,pw\npiet,q@i.org,pw\n')
+    assert result.exit_code == 0, result.output
+    assert 'Imported 1 users' in result.output
+    with atomic(dbfile) as cursor:
+        assert get_user(cursor, 'piet').email == 'q@i.org'
+
+
+def test_iter_users(dbfile):
+    with atomic(dbfile) as cursor:
+        for i in range(5):
+            create_user(cursor, username=f'user{i}', password='pw',
+                        email=f'{i}@i.org', groups=['odd'] if i % 2 else [])
+        login_user(cursor, 'user1')
+    users = list(iter_users(dbfile, pagesize=2))
+    assert [u['username'] for u in users] == [f'user{i}' for i in range(5)]
+    assert [u['username'] for u in iter_users(dbfile, group='odd',
+                                              pagesize=1)] == ['user1',
+                                                               'user3']
+    assert list(iter_groups(dbfile)) == [{'groupid': 1, 'name': 'odd'}]
+    assert [s['username'] for s in iter_sessions(dbfile)] == ['user1']
+
+    # csv exports can be imported again
+    stream = io.StringIO()
+    write_rows(iter_users(dbfile, hashes=True), stream, 'csv')
+    stream.seek(0)
+    rows = list(read_users(stream))
+    assert rows[1]['groups'] == ['odd']
+    assert rows[1]['password_hash'].startswith('$argon2')
+
+
+def test_session_expiry(dbfile):
+    with atomic(dbfile) as cursor:
+        for i in range(5):
+            create_user(cursor, username=f'user{i}', password='pw',
+                        email=f'{i}@i.org')
+            login_user(cursor, f'user{i}', lifetime=-1 if i else 60)
+        key = login_user(cursor, 'user1', lifetime=-1)
+        assert get_session_user(cursor, key) is None
+    assert reap_sessions(dbfile, batch=2) == 5
+    assert [s['username'] for s in iter_sessions(dbfile)] == ['user0']
+
+    result = CliRunner().invoke(cli, ['-db', dbfile, 'sessions', 'purge'])
+    assert 'Deleted 0 expired sessions' in result.output
+
+
+def test_migrate(dbfile):
+    # turn the database back into the original schema
+    with atomic(dbfile) as cursor:
+        create_user(cursor, username='pieter', password='123abc', 
+                    email='p@i.org')
+        cursor.execute("DROP TABLE sessions")
+        cursor.execute("""
+            CREATE TABLE sessions(
+                userid   INTEGER PRIMARY KEY,
+                key      TEXT NOT NULL,
+                started  TEXT DEFAULT (datetime('now'))
+            );
+        """)
+        cursor.execute("INSERT INTO sessions (userid, key) VALUES (1, 'old')")
+        cursor.execute("DROP INDEX idx_usergroups_groupid")
+        cursor.execute("DROP TABLE revocations")
+        cursor.execute("PRAGMA user_version = 0")
+
+    with pytest.raises(ValueError, match='bottle-yaap migrate'):
+        json_app({'auth': {'dbfile': dbfile}})
+    result = CliRunner().invoke(cli, ['-db', dbfile, 'migrate'])
+    assert result.exit_code == 0, result.output
+    with atomic(dbfile) as cursor:
+        assert schema_version(cursor) == SCHEMA_VERSION
+        indexes = {row[0] for row in cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'")}
+        assert {'idx_sessions_userid', 'idx_usergroups_groupid'} <= indexes
+        assert [s['username'] for s in iter_sessions(dbfile)] == ['pieter']
+        # sessions started before the upgrade stay valid
+        assert get_session_user(cursor, 'old').username == 'pieter'
+    json_app({'auth': {'dbfile': dbfile}}).close()
+
+
+@pytest.mark.parametrize('store', ['memory', 'sqlite'])
+def test_session_store(dbfile, store):
+    sessions = (MemorySessionStore() if store == 'memory'
+                else SQLiteSessionStore(dbfile))
+    with atomic(dbfile) as cursor:
+        for i in range(3):
+            create_user(cursor, username=f'user{i}', password='pw',
+                        email=f'{i}@i.org')
+    first = sessions.create(1, 60)
+    key = sessions.create(1, 60)
+    assert sessions.lookup(first) == sessions.lookup(key) == 1
+    expired = sessions.create(2, -1)
+    assert sessions.lookup(expired) is None
+    sessions.touch(expired, 60)
+    assert sessions.lookup(expired) == 2
+    sessions.create(3, -1)
+    assert sessions.purge() == 1
+    sessions.revoke(key=key)
+    assert sessions.lookup(key) is None
+    assert sessions.lookup(first) == 1
+    sessions.revoke(userid=1)
+    assert sessions.lookup(first) is None
+    sessions.revoke(userid=2)
+    assert sessions.lookup(expired) is None
+
+
+def test_session_store_interface():
+    class Incomplete(SessionStore):
+        def create(self, userid, lifetime):
+            return 'key'
+
+    with pytest.raises(TypeError, match='touch_many'):
+        Incomplete()
+
+
+def test_plugin_memory_sessions(dbfile):
+    app = make_app(dbfile, session_store='memory')
+    cookie = login(app)
+    assert call(app, '/testers/', cookie=cookie)[0] == 200
+    with atomic(dbfile) as cursor:
+        count = cursor.execute("SELECT count(*) FROM sessions").fetchone()
+        assert count[0] == 0
+    call(app, '/logout/', 'POST', cookie=cookie)
+    assert call(app, '/whoami/', cookie=cookie)[0] == 302
+    app.close()
+
+
+def test_session_dbfile(tmpdir):
+    dbfile = str(tmpdir.join('users.db'))
+    session_dbfile = str(tmpdir.join('sessions.db'))
+    runner = CliRunner()
+    result = runner.invoke(cli, ['-db', dbfile, '-sdb', session_dbfile,
+                                 'init'])
+    assert result.exit_code == 0, result.output
+    app = make_app(dbfile, session_dbfile=session_dbfile)
+    cookie = login(app)
+    assert call(app, '/testers/', cookie=cookie)[0] == 200
+    with atomic(session_dbfile) as cursor:
+        count = cursor.execute("SELECT count(*) FROM sessions").fetchone()
+        assert count[0] == 1
+    assert [s['username'] for s in iter_sessions(
+        dbfile, session_dbfile=session_dbfile)] == ['pieter']
+
+    result = runner.invoke(cli, ['-db', dbfile, '-sdb', session_dbfile,
+                                 'logout', 'pieter'])
+    assert result.exit_code == 0, result.output
+    assert call(app, '/testers/', cookie=cookie)[0] == 302
+    result = runner.invoke(cli, ['-db', dbfile, '-sdb', session_dbfile,
+                                 'migrate'])
+    assert (f'sessions.db schema is at version {SESSION_SCHEMA_VERSION}'
+            in result.output)
+    app.close()
+
+
+def test_group_bitmask(app, dbfile):
+    @app.get('/special/', auth={'special', 'unknown'})
+    def special():
+        return {}
+
+    cookie = login(app)
+    assert call(app, '/special/', cookie=cookie)[0] == 403
+    # a group created behind the plugin's back shows up as an unknown bit
+    with atomic(dbfile) as cursor:
+        cursor.execute("INSERT INTO groups (name) VALUES ('special')")
+        cursor.execute("INSERT INTO usergroups VALUES (1, ?)",
+                       (cursor.lastrowid,))
+    app.plugins[-1].cache.clear()
+    assert call(app, '/special/', cookie=cookie)[0] == 200
+    with atomic(dbfile) as cursor:
+        update_user(cursor, 'pieter', 'groups', {'testers'})
+    assert call(app, '/special/', cookie=cookie)[0] == 403
+
+
+def test_generation(dbfile):
+    app = make_app(dbfile, poll_interval=0)
+    cookie = login(app)
+    assert call(app, '/whoami/', cookie=cookie)[0] == 200
+    # changes made by another process only become visible with a new
+    # generation
+    with atomic(dbfile) as cursor:
+        cursor.execute("DELETE FROM usergroups")
+    assert call(app, '/testers/', cookie=cookie)[0] == 200
+    with atomic(dbfile) as cursor:
+        cursor.execute("UPDATE generation SET value = value + 1")
+    assert call(app, '/testers/', cookie=cookie)[0] == 403
+    with atomic(dbfile) as cursor:
+        cursor.execute("UPDATE generation SET value = value + 1")
+        cursor.execute("REPLACE INTO settings VALUES ('cookie_key', 'yaap')")
+    assert call(app, '/testers/', cookie=cookie)[0] == 302
+    assert app.config['auth.cookie_key'] == 'yaap'
+    app.close()
+
+
+def test_shared_session_cache(tmpdir):
+    path = str(tmpdir.join('yaap.cache'))
+    writer = SharedSessionCache(path, slots=64)
+    reader = SharedSessionCache(path, slots=64)
+    # the groupmask is left to the reader
+    pieter = User('pieter', 'p@i.org', frozenset({'testers'}))
+    writer.set('key', pieter._replace(groupmask=1 << 20000), generation=1)
+    assert reader.get('key', generation=1) == pieter
+    assert reader.get('key', generation=2) is None
+    assert reader.get('other', generation=1) is None
+    writer.invalidate('key')
+    assert reader.get('key', generation=1) is None
+    writer.set('key', pieter, generation=1)
+    reader.invalidate_all()
+    assert writer.get('key', generation=1) is None
+    # a writer that died halfway leaves an odd sequence number
+    writer.set('key', pieter, generation=1)
+    digest, offset, _ = writer._slot('key')
+    writer.map[offset] |= 1
+    assert reader.get('key', generation=1) is None
+    writer.set('key', pieter, generation=1)
+    assert reader.get('key', generation=1) == pieter
+    assert reader.stats()['hits'] == 2
+    writer.close()
+    reader.close()
+
+
+def test_plugin_shared_cache(dbfile, tmpdir, monkeypatch):
+    app = make_app(dbfile, session_cache=0,
+                   shared_cache=str(tmpdir.join('yaap.cache')))
+    cookie = login(app)
+    auth = app.plugins[-1]
+    monkeypatch.setattr(auth, 'get_session_user', None)
+    assert call(app, '/testers/', cookie=cookie)[0] == 200
+    monkeypatch.undo()
+    call(app, '/logout/', 'POST', cookie=cookie)
+    assert call(app, '/testers/', cookie=cookie)[0] == 302
+    app.close()
+
+
+def test_plugin_shared_cache_large_groupid(dbfile, tmpdir):
+    with atomic(dbfile) as cursor:
+        cursor.execute("INSERT INTO groups VALUES (20000, 'testers')")
+    app = make_app(dbfile, session_cache=0,
+                   shared_cache=str(tmpdir.join('yaap.cache')))
+    cookie = login(app)
+    assert cookie
+    assert call(app, '/testers/', cookie=cookie)[0] == 200
+    assert call(app, '/testers/', cookie=cookie)[0] == 200
+    assert app.plugins[-1].shared.stats()['hits'] >= 1
+    app.close()
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(1000)
+    for i in range(1000):
+        bloom.add(f'key{i}')
+    assert all(f'key{i}' in bloom for i in range(1000))
+    false_positives = sum(f'other{i}' in bloom for i in range(1000))
+    assert false_positives < 50
+
+
+def test_session_filter(dbfile):
+    with atomic(dbfile) as cursor:
+        create_user(cursor, username='pieter', password='123abc',
+                    email='p@i.org')
+    pool = ConnectionPool(dbfile)
+    sessions = SQLiteSessionStore(pool)
+    known = sessions.create(1, 60)
+    session_filter = SessionFilter(sessions, capacity=100)
+    assert session_filter.might_exist(known)
+    assert not session_filter.might_exist('forged')
+    assert not session_filter.might_exist('forged')
+    assert session_filter.stats()['rejected'] == 2
+    # a session started by another process is picked up
+    other = SQLiteSessionStore(dbfile).create(1, 60)
+    assert session_filter.might_exist(other)
+    # as is one that committed late, stamped before the last refresh
+    with atomic(dbfile) as cursor:
+        late = create_session(cursor, 1, 60)
+        cursor.execute("UPDATE sessions SET started = started - 10 "
+                       "WHERE key = ?", (session_digest(late),))
+    assert session_filter.might_exist(late)
+    pool.close()
+
+
+def test_session_filter_rebuild(dbfile):
+    with atomic(dbfile) as cursor:
+        create_user(cursor, username='pieter', password='123abc',
+                    email='p@i.org')
+    sessions = MemorySessionStore()
+    keys = [sessions.create(1, 60) for _ in range(2000)]
+    session_filter = SessionFilter(sessions, capacity=4000,
+                                   rebuild_interval=3600)
+    sessions.revoke(userid=1)
+    assert session_filter.might_exist(keys[0])
+    # the dead keys are dropped once the filter is rebuilt
+    session_filter.rebuild_interval = 0
+    assert not any(session_filter.might_exist(key) for key in keys)
+    assert session_filter.stats()['keys'] == 0
+
+
+def test_plugin_purge_rebuilds_filter(dbfile):
+    app = make_app(dbfile, session_filter=1000)
+    cookie = login(app)
+    auth = app.plugins[-1]
+    with atomic(dbfile) as cursor:
+        cursor.execute("UPDATE sessions SET expires = 0")
+    assert auth.filter.stats()['keys'] == 1
+    assert auth.purge_sessions() == 1
+    assert auth.filter.stats()['keys'] == 0
+    assert call(app, '/testers/', cookie=cookie)[0] == 302
+    app.close()
+
+
+def test_plugin_session_filter(dbfile):
+    app = make_app(dbfile, session_filter=1000)
+    cookie = login(app)
+    assert call(app, '/testers/', cookie=cookie)[0] == 200
+    call(app, '/logout/', 'POST', cookie=cookie)
+    assert call(app, '/testers/', cookie=cookie)[0] == 302
+    assert app.plugins[-1].filter.stats()['negative'] == 1
+    app.close()
+
+
+def test_cookie_codec():
+    cookie = encode_cookie('yaap', 'a.key', 'secret')
+    assert decode_cookie('yaap', cookie, 'secret') == 'a.key'
+    assert decode_cookie('other', cookie, 'secret') is None
+    assert decode_cookie('yaap', cookie, 'other secret') is None
+    assert decode_cookie('yaap', 'b' + cookie[1:], 'secret') is None
+    assert decode_cookie('yaap', 'garbage', 'secret') is None
+    assert decode_cookie('yaap', 'abc.\xe9', 'secret') is None
+    assert decode_cookie('yaap', '\xe9.' + cookie.split('.')[-1],
+                         'secret') is None
+
+
+def test_legacy_cookies(dbfile):
+    with pytest.raises(ValueError, match='cookie_secret'):
+        json_app({'auth': {'dbfile': dbfile, 'cookie_format': 'legacy'}})
+    with pytest.raises(ValueError, match='cookie_secret'):
+        json_app({'auth': {'dbfile': dbfile, 'cookie_legacy': True}})
+    legacy = make_app(dbfile, cookie_format='legacy', cookie_secret='s3cret')
+    cookie = login(legacy)
+    assert cookie.split('=', 1)[1].startswith('"!')
+    legacy.close()
+
+    app = json_app({'auth': {'dbfile': dbfile, 'cookie_secret': 's3cret',
+                             'cookie_legacy': True}})
+
+    @app.get('/whoami/', auth=set())
+    def whoami():
+        return request.user.username
+
+    assert call(app, '/whoami/', cookie=cookie)[2] == b'pieter'
+    app.config['auth.cookie_legacy'] = False
+    assert call(app, '/whoami/', cookie=cookie)[0] == 302
+    app.close()
+
+
+class Exploit(object):
+    ran = False
+
+    def __reduce__(self):
+        return (setattr, (Exploit, 'ran', True))
+
+
+def test_forged_pickle_cookie(app):
+    # a bottle signed cookie made with the public default secret
+    payload = base64.b64encode(pickle.dumps(['bottle_yaap', Exploit()], -1))
+    signature = base64.b64encode(hmac.new(
+        b'sneakyyaapi', payload, hashlib.sha256).digest())
+    cookie = 'bottle_yaap="!%s?%s"' % (signature.decode(),
+                                        payload.decode())
+    assert call(app, '/whoami/', cookie=cookie)[0] == 302
+    assert not Exploit.ran
+
+
+def test_session_toucher(dbfile):
+    with atomic(dbfile) as cursor:
+        create_user(cursor, username='pieter', password='123abc',
+                    email='p@i.org')
+    sessions = SQLiteSessionStore(dbfile)
+    key = sessions.create(1, 5)
+    toucher = SessionToucher(sessions, lifetime=3600, interval=3600,
+                             batch=2)
+    toucher.start()
+    toucher.touch(key)
+    toucher.touch(key)
+    assert toucher.stats()['pending'] == 1
+    # reaching the batch size wakes the thread
+    toucher.touch(sessions.create(1, 5))
+    for _ in range(100):
+        if toucher.stats()['flushes']:
+            break
+        time.sleep(0.01)
+    assert toucher.stats() == {'pending': 0, 'flushes': 1, 'flushed': 2}
+    with atomic(dbfile) as cursor:
+        expires = cursor.execute("SELECT expires FROM sessions WHERE key = ?",
+                                 (session_digest(key),)).fetchone()[0]
+    assert expires >= time.time() + 3590
+    toucher.stop()
+    assert not toucher.is_alive()
+
+
+def test_session_toucher_fork(dbfile):
+    sessions = MemorySessionStore()
+    toucher = SessionToucher(sessions, lifetime=3600, interval=3600)
+    toucher.touch('key')
+    assert toucher.is_alive()
+    pid = os.fork()
+    if pid == 0:
+        # the child starts its own thread on first use
+        alive = toucher.is_alive()
+        toucher.touch('other')
+        os._exit(0 if not alive and toucher.is_alive()
+                 and list(toucher.pending) == ['other'] else 1)
+    assert os.waitpid(pid, 0)[1] == 0
+    toucher.stop()
+
+
+def test_plugin_sliding_expiry(dbfile):
+    app = make_app(dbfile, touch_interval=3600)
+    # the thread starts with the first request, not in setup
+    assert not app.plugins[-1].toucher.is_alive()
+    cookie = login(app)
+    with atomic(dbfile) as cursor:
+        cursor.execute("UPDATE sessions SET expires = expires - 10000")
+    assert call(app, '/testers/', cookie=cookie)[0] == 200
+    assert call(app, '/testers/', cookie=cookie)[0] == 200
+    assert app.plugins[-1].toucher.stats()['pending'] == 1
+    # closing the plugin writes the pending activity
+    app.close()
+    with atomic(dbfile) as cursor:
+        expires = cursor.execute("SELECT expires FROM sessions").fetchone()[0]
+    assert expires >= time.time() + 10790
+
+
+@pytest.mark.parametrize('store', ['memory', 'sqlite'])
+def test_login_throttle(dbfile, store):
+    limits = dict(burst=2, rate=0.001, addr_burst=3, addr_rate=0.001)
+    throttle = (LoginThrottle(**limits) if store == 'memory'
+                else SQLiteLoginThrottle(dbfile, **limits))
+    throttle.acquire('pieter', '10.0.0.1')
+    throttle.acquire('pieter', '10.0.0.1')
+    with pytest.raises(Throttled) as e:
+        throttle.acquire('pieter', '10.0.0.2')
+    assert e.value.retry_after > 900
+    # the rejected attempt did not use up the address
+    throttle.acquire('jan', '10.0.0.1')
+    with pytest.raises(Throttled):
+        throttle.acquire('piet', '10.0.0.1')
+    throttle.acquire('piet', '10.0.0.2')
+    assert throttle.stats()['allowed'] == 4
+    assert throttle.stats()['throttled'] == 2
+    if store == 'sqlite':
+        # buckets are shared between processes
+        other = SQLiteLoginThrottle(dbfile, **limits)
+        with pytest.raises(Throttled):
+            other.acquire('pieter')
+
+
+def test_plugin_login_throttle(dbfile, monkeypatch):
+    app = make_app(dbfile, login_throttle='memory', login_burst=2)
+    auth = app.plugins[-1]
+    body = {'username': 'pieter', 'password': 'wrong'}
+    assert call(app, '/login/', 'POST', body=body)[0] == 401
+    assert call(app, '/login/', 'POST', body=body)[0] == 401
+    monkeypatch.setattr(auth.hasher, 'verify', None)
+    assert call(app, '/login/', 'POST', body=body)[0] == 429
+    assert auth.throttle.stats()['throttled'] == 1
+    app.close()
+
+
+def test_calibrate(dbfile):
+    params, seconds = calibrate(latency=0.05, concurrency=2, max_memory=4096)
+    assert params['memory_cost'] <= 2048
+    assert params['time_cost'] >= 1
+    assert params['parallelism'] >= 1
+    result = CliRunner().invoke(cli, ['-db', dbfile, 'calibrate',
+                                      '--latency', '0.05',
+                                      '--max-memory', '4'])
+    assert result.exit_code == 0, result.output
+    with atomic(dbfile) as cursor:
+        assert get_conf(cursor)['argon2_time_cost'] >= 1
+
+
+def test_configure_hash_settings(dbfile):
+    with atomic(dbfile) as cursor:
+        for value in ('fast', 0, -1):
+            with pytest.raises(ValueError, match='positive integer'):
+                configure(cursor, 'argon2_time_cost', value)
+        configure(cursor, 'argon2_time_cost', '3')
+        assert get_conf(cursor)['argon2_time_cost'] == 3
+        configure(cursor, 'argon2_time_cost', None)
+        assert get_conf(cursor)['argon2_time_cost'] is None
+    result = CliRunner().invoke(
+        cli, ['-db', dbfile, 'configure', 'argon2_time_cost', 'fast'])
+    assert result.exit_code == 1
+    assert 'positive integer' in result.output
+
+
+def test_rehash_on_login(dbfile):
+    with atomic(dbfile) as cursor:
+        configure(cursor, 'argon2_time_cost', 1)
+        configure(cursor, 'argon2_memory_cost', 1024)
+        configure(cursor, 'argon2_parallelism', 1)
+    app = make_app(dbfile, poll_interval=0)
+    # other processes see new parameters through the generation counter
+    with atomic(dbfile) as cursor:
+        configure(cursor, 'argon2_time_cost', 2)
+    for _ in range(2):
+        login(app)
+        with atomic(dbfile) as cursor:
+            pw_hash = cursor.execute("SELECT password FROM users").fetchone()
+            assert '$m=1024,t=2,p=1$' in pw_hash[0]
+    app.close()
+
+
+def test_group_members(dbfile):
+    with atomic(dbfile) as cursor:
+        create_users(cursor, [{'username': f'user{i}', 'email': f'{i}@i.org',
+                               'password_hash': 'x', 'groups': ['old']}
+                              for i in range(100)])
+    with atomic(dbfile) as cursor:
+        usernames = [f'user{i}' for i in range(0, 100, 2)] + ['nobody']
+        assert add_group_members(cursor, 'even', usernames) == 50
+        assert add_group_members(cursor, 'even', ['user0', 'user1']) == 1
+        assert remove_group_members(cursor, 'even', ['user0', 'user3']) == 1
+        set_user_groups(cursor, 'user2', {'new', 'old'})
+        assert get_usergroups(cursor, 'user2') == {'new', 'old'}
+        update_user(cursor, 'user4', 'groups', set())
+        assert get_usergroups(cursor, 'user4') == set()
+    assert len(list(iter_users(dbfile, group='even'))) == 48
+
+    result = CliRunner().invoke(cli, ['-db', dbfile, 'group', 'remove',
+                                      'old', 'user5', '-f', '-'],
+                                input='user6\nuser7\n')
+    assert 'Removed 3 users' in result.output
+    assert len(list(iter_users(dbfile, group='old'))) == 96
+
+
+def test_batch(dbfile):
+    commands = [
+        {'command': 'create', 'username': 'pieter', 'email': 'p@i.org',
+         'password': '123abc', 'groups': ['testers']},
+        {'command': 'create', 'username': 'pieter', 'email': 'p@i.org'},
+        {'command': 'create', 'username': 'jan', 'email': 'j@i.org'},
+        {'command': 'update', 'username': 'jan', 'attr': 'groups',
+         'value': ['testers']},
+        {'command': 'configure', 'key': 'nope', 'value': 1},
+        {'command': 'remove'},
+        {'command': 'remove', 'username': 'pieter'},
+    ]
+    lines = [json.dumps(command) for command in commands] + ['', '{']
+    results = list(run_batch(dbfile, lines, group=3))
+    assert [r['ok'] for r in results] == [True, False, True, True, False,
+                                          False, True, False]
+    assert 'password' in results[2]
+    assert results[5]['error'] == "missing 'username'"
+    assert results[7]['line'] == 9
+    with atomic(dbfile) as cursor:
+        assert users_in_group(cursor, 'testers') == {'jan'}
+
+    result = CliRunner().invoke(cli, ['-db', dbfile, 'batch'],
+                                input=lines[6] + '\n')
+    assert json.loads(result.output) == {'line': 1, 'command': 'remove',
+                                         'ok': True}
+
+
+def test_batch_server(dbfile, tmpdir):
+    path = str(tmpdir.join('yaap.sock'))
+    server = batch_server(dbfile, path)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    client = socket.socket(socket.AF_UNIX)
+    client.connect(path)
+    stream = client.makefile('rwb')
+    for username in ('pieter', 'pieter'):
+        stream.write(json.dumps({'command': 'create', 'username': username,
+                                 'email': 'p@i.org'}).encode() + b'\n')
+        stream.flush()
+        result = json.loads(stream.readline())
+    # every command is committed on its own
+    assert result['ok'] is False and result['line'] == 2
+    with atomic(dbfile) as cursor:
+        assert get_user(cursor, 'pieter').email == 'p@i.org'
+    stream.close()
+    client.close()
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_lazy_imports():
+    # neither importing the module nor --help loads bottle or passlib
+    code = ("import sys, bottle_yaap; "
+            "bottle_yaap.cli(['--help'], standalone_mode=False); "
+            "print(type(sys.modules['bottle']).__name__, "
+            "'passlib' in sys.modules)")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, '-c', code], text=True,
+                            capture_output=True, check=True,
+                            env=dict(os.environ, PYTHONPATH=root))
+    assert result.stdout.splitlines()[-1] == '_LazyModule False'